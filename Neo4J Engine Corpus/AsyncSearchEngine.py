@@ -0,0 +1,137 @@
+from neo4j import AsyncGraphDatabase
+from SearchEngine import *
+from SearchEngine import _subfeat_candidates, _subfeat_matches
+import asyncio
+
+
+
+#####################################################  Async Engine  #####################################################
+
+"""
+AsyncGraphEngine:
+    Purpose:
+        asyncio counterpart of GraphEngine, owns a configured async Neo4j driver & its connection pool. The query
+        functions in this module run on the current async engine, set by entering the engine with 'async with' or
+        with use_async_engine. Every query borrows a pooled connection, so concurrent searches never share a session
+    Input:
+        uri, user, password (str) - database location & credentials
+        max_connection_pool_size (int) - max number of pooled connections
+        connection_acquisition_timeout (float) - seconds to wait for a free pooled connection before failing
+        fetch_size (int) - number of records fetched per round trip when reading results
+        database (str) - database name, None for the server default
+"""
+class AsyncGraphEngine:
+    def __init__(self, uri, user, password, max_connection_pool_size=100, connection_acquisition_timeout=60, fetch_size=1000, database=None):
+        self.driver = AsyncGraphDatabase.driver(uri, auth=(user, password), max_connection_pool_size=max_connection_pool_size,
+                                                connection_acquisition_timeout=connection_acquisition_timeout)
+        self.fetch_size = fetch_size
+        self.database = database
+
+    def session(self):
+        return self.driver.session(database=self.database, fetch_size=self.fetch_size)
+
+    async def verify_connectivity(self):
+        await self.driver.verify_connectivity()
+
+    # close every pooled connection, the engine can't be used afterwards
+    async def close(self):
+        if current_async_engine_or_none() is self:
+            use_async_engine(None)
+        await self.driver.close()
+
+    async def __aenter__(self):
+        self.previous = current_async_engine_or_none()
+        use_async_engine(self)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.driver.close()
+        use_async_engine(self.previous)
+
+
+_async_engine = None
+
+# make engine the one used by the async functions in this module, None to unset it
+def use_async_engine(engine):
+    global _async_engine
+    _async_engine = engine
+
+def current_async_engine_or_none():
+    return _async_engine
+
+def current_async_engine():
+    if _async_engine == None:
+        raise RuntimeError("no AsyncGraphEngine in use, enter one with 'async with AsyncGraphEngine(...)' or call use_async_engine")
+    return _async_engine
+
+
+
+#####################################################  Async Query Database  #####################################################
+
+# the async queries share query_cache with SearchEngine.py, so ingestion invalidates them too
+
+# ingest generation of the database, None if no async engine is in use
+async def corpus_generation_async():
+    engine = current_async_engine_or_none()
+    if engine == None:
+        return None
+    async with engine.session() as session:
+        result = await session.run(qmap["corpus_generation"])
+        return (await result.single())["generation"]
+
+query_cache.async_generation_source = corpus_generation_async
+
+
+# Find equations containing all features in feature_list
+@cached_async_query(query_cache, canonical_feature_set)
+async def eqns_with_feats_async(feature_list):
+    async with current_async_engine().session() as session:
+        result = await session.run(qmap["eqns_with_feats"], {'feature_list': [feature_key(f) for f in feature_list]})
+        return [record["equation"] async for record in result]
+
+
+# Find equations & corresp. ftrs containing S as subfeature
+@cached_async_query(query_cache, canonical_sequence)
+async def eqns_with_subfeat_async(S):
+    query, parameters = _subfeat_candidates(S)
+    async with current_async_engine().session() as session:
+        candidates = await session.run(query, parameters)
+        feature_ids = _subfeat_matches(S, [record async for record in candidates])
+        if feature_ids == []:
+            return []
+        result = await session.run(qmap["eqns_with_feature_ids"], {"feature_ids": feature_ids})
+        return [(record['equation_id'], record['all_features']) async for record in result]
+
+
+# Find equations matching with some features in feature_list
+@cached_async_query(query_cache, canonical_feature_set)
+async def match_some_ftrs_async(feature_list):
+    async with current_async_engine().session() as session:
+        result = await session.run(qmap["match_some_ftrs"], {'feature_list': [feature_key(f) for f in feature_list]})
+        return [(record["equation"], record["num_matched"], record["total_features"]) async for record in result if record["num_matched"] > 0]
+
+
+# Find equations matching with some subfeatures in subfeatures_list
+@cached_async_query(query_cache, canonical_operator_sets)
+async def match_some_subfeats_ordered_async(subfeatures_list):
+    async with current_async_engine().session() as session:
+        result = await session.run(qmap["match_some_subfeats_ordered"], {"subsequences": subfeatures_list})
+        return [(record['equation_id'], record['matched_subfeature_count'], record['total_features']) async for record in result]
+
+
+
+"""
+ranked_results_async:
+    Purpose:
+        async ranked_results, the exact & subfeature queries run concurrently on separate pooled connections.
+        results are returned instead of plotted
+    Input:
+        feature_list (list[list[str]]) - query features
+    Output:
+        list of (equation, score) in descending score order
+"""
+async def ranked_results_async(feature_list):
+    exact_matches, subftr_matches = await asyncio.gather(match_some_ftrs_async(feature_list),
+                                                         match_some_subfeats_ordered_async(feature_list))
+    eq_to_rank = score_matches(len(feature_list), exact_matches, subftr_matches)
+    return sorted(((list(eq), rank) for eq, rank in eq_to_rank.items()), key=lambda item: -item[1])
@@ -0,0 +1,255 @@
+from MathMLLibrary.pull_features import *
+from MathMLLibrary.html_to_tree import *
+from MathMLLibrary.tree_keys import *
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from collections import OrderedDict
+import traceback
+import hashlib
+import sqlite3
+import math
+import time
+import os
+
+
+
+#####################################################  Document Extraction  #####################################################
+
+# max number of distinct features, summed over the cached equations, whose extraction is kept by each process.
+# an equation's size grows with the square of its leaf count, so the cache is bounded by features rather than
+# equations, a cached feature takes about 250 bytes
+EXTRACTED_CACHE_FEATURES = 250000
+# Key: equation_key of a tree extracted by this process, Value: (features, stats), least recently used first
+_extracted = OrderedDict()
+# number of features held by _extracted
+_extracted_features = 0
+
+
+
+"""
+extract_document:
+    Purpose:
+        parse a corpus document & extract everything ingestion needs from it, the result only holds
+        strings & tuples so it is cheap to pickle back from a worker process. equations are identified by the
+        order sensitive equation_key, since feature paths depend on operand order, & the features of a key this
+        process has already extracted are reused. features of new equations reuse the sub-expressions cached in
+        FEATURE_CACHE. the equation_fingerprint of each equation is returned alongside its key, so equations
+        equal up to reordering commutative operands can be found. equations toOpTree finds no operator tree for are
+        left out, they would all share the key of the empty tree
+    Input:
+        file (str) - path to html document
+        standardize (bool) - standardize variable names, so equations differing only in them get the same key
+    Output:
+        (doc name, equations) where equations is a list of
+        (equation key, equation fingerprint, mathml string, latex alttext, list of (feature key, operators, tf),
+        equation_statistics dict) with distinct features per equation, tf is the number of times the feature path
+        occurs in the equation
+"""
+def extract_document(file, standardize=False):
+    global _extracted_features
+    equations = []
+    for mathml, latex, tree in iterEquations(file, compact=True, standardize=standardize):
+        if len(tree) == 0:
+            continue
+        eq_key = equation_key(tree)
+        cached = _extracted.get(eq_key)
+        if cached == None:
+            tfs = {}                        # Key: feature as symbol ids, Value: tf
+            for codes in extractFeatureCodesMemoized(tree):
+                tfs[codes] = tfs.get(codes, 0) + 1
+            # symbol ids are local to this process, so features leave it as labels
+            features = [(feature_key(feature), feature, tf) for feature, tf in
+                        ((tree.symbols.decode(codes), tf) for codes, tf in tfs.items())]
+            cached = (features, equation_statistics(tree, list(tfs)))
+            if len(features) <= EXTRACTED_CACHE_FEATURES:
+                _extracted[eq_key] = cached
+                _extracted_features += len(features)
+                while _extracted_features > EXTRACTED_CACHE_FEATURES:
+                    _extracted_features -= len(_extracted.popitem(last=False)[1][0])
+        else:
+            _extracted.move_to_end(eq_key)
+        features, stats = cached
+        equations.append((eq_key, equation_fingerprint(tree), mathml, latex, features, stats))
+    return os.path.basename(file), equations
+
+
+
+# extract_document wrapper for the process pool, errors are returned instead of raised so one bad document doesn't stop ingestion
+# (toOpTree exits when an equation has no content mathml). the FEATURE_CACHE stats of the process are returned with the result
+def _try_extract_document(file, standardize=False):
+    try:
+        return file, extract_document(file, standardize), None, (os.getpid(), FEATURE_CACHE.stats())
+    except (Exception, SystemExit):
+        return file, None, traceback.format_exc(), (os.getpid(), FEATURE_CACHE.stats())
+
+
+
+# FEATURE_CACHE stats summed over processes, cache_stats maps each process id to the latest stats it returned
+def combine_cache_stats(cache_stats):
+    total = {"size": 0, "num_features": 0, "hits": 0, "misses": 0, "skipped": 0}
+    for stats in cache_stats.values():
+        for name in total:
+            total[name] += stats[name]
+    lookups = total["hits"] + total["misses"]
+    total["hit_rate"] = total["hits"] / lookups if lookups > 0 else 0.0
+    return total
+
+
+
+"""
+iter_extracted_documents:
+    Purpose:
+        fan extract_document out over a process pool & stream the results back to a single consumer,
+        at most max_pending documents are in flight so a slow consumer holds back the workers
+    Input:
+        files (iterable[str]) - paths to html documents
+        workers (int) - number of worker processes, documents are extracted in this process when workers <= 1
+        max_pending (int) - max number of submitted documents whose results haven't been consumed, defaults to 4 per worker
+        standardize (bool) - passed on to extract_document
+    Output:
+        generator of (file, extract_document result, None, cache stats) or (file, None, error traceback, cache stats)
+        in completion order, cache stats is (process id, FEATURE_CACHE.stats()) of the process that extracted the file
+"""
+def iter_extracted_documents(files, workers=os.cpu_count(), max_pending=None, standardize=False):
+    if workers == None or workers <= 1:
+        for file in files:
+            yield _try_extract_document(file, standardize)
+        return
+
+    if max_pending == None:
+        max_pending = 4 * workers
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for file in files:
+            pending.add(pool.submit(_try_extract_document, file, standardize))
+            # wait for a slot before submitting more work
+            while len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+
+#####################################################  Scoring  #####################################################
+
+# BM25 parameters, K1 saturates repeated feature paths & B scales the normalization by equation feature count
+BM25_K1 = 1.2
+BM25_B = 0.75
+# max number of subsequences of a query feature tried by eqns_with_partial_feature, in both engines
+PARTIAL_MATCH_LIMIT = 64
+
+
+
+# inverse equation frequency of a feature path found in df of num_equations equations, never negative
+def bm25_idf(df, num_equations):
+    return math.log(1 + (num_equations - df + 0.5) / (df + 0.5))
+
+
+
+"""
+bm25_weight:
+    Purpose:
+        score contribution of one matched feature path, the same formula is used by the Neo4j query & the offline index
+    Input:
+        idf (float) - bm25_idf of the feature path
+        tf (int) - number of times the feature path occurs in the equation
+        num_features (int) - number of distinct features of the equation
+        avg_num_features (float) - mean num_features over the corpus
+        k1, b (float) - BM25 parameters
+    Output:
+        float - at most idf * (k1 + 1) for any tf & equation size, when b < 1
+"""
+def bm25_weight(idf, tf, num_features, avg_num_features, k1=BM25_K1, b=BM25_B):
+    return idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * num_features / avg_num_features))
+
+
+
+#####################################################  Ingestion Manifest  #####################################################
+
+# manifest table, one row per ingested document
+MANIFEST_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS documents (
+        path TEXT PRIMARY KEY,
+        size INTEGER,
+        mtime REAL,
+        sha256 TEXT,
+        status TEXT,
+        error TEXT,
+        updated REAL
+    )
+"""
+# document states recorded in the manifest
+PENDING, DONE, FAILED = "pending", "done", "failed"
+
+
+
+# sha256 of a file's contents
+def file_sha256(file):
+    h = hashlib.sha256()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+
+"""
+IngestManifest:
+    Purpose:
+        SQLite record of every document's path, size, mtime, content hash & ingestion status, so re-runs only
+        process new & changed documents & resume after a crash or a failed document
+    Input:
+        path (str) - manifest database file, created if it doesn't exist
+"""
+class IngestManifest:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute(MANIFEST_SCHEMA)
+        self.db.commit()
+        # Key: path, Value: (size, mtime, sha256) of documents planned for ingestion
+        self.planned = {}
+
+    def close(self):
+        self.db.close()
+
+    """
+    plan:
+        Purpose:
+            decide which documents need to be ingested
+        Input:
+            files (list[str]) - paths to every document in the corpus
+        Output:
+            dict - Key: path of a new, changed or unfinished document, Value: True if the document may already have
+                   edges in the graph that must be removed before it is re-indexed
+    """
+    def plan(self, files):
+        todo = {}
+        for file in files:
+            stat = os.stat(file)
+            row = self.db.execute("SELECT size, mtime, sha256, status FROM documents WHERE path = ?", (file,)).fetchone()
+            if row != None and row[3] == DONE and row[0] == stat.st_size and row[1] == stat.st_mtime:
+                continue
+            sha = file_sha256(file)
+            if row != None and row[3] == DONE and row[2] == sha:
+                # touched but unchanged, remember the new size & mtime so it isn't hashed again
+                self._record(file, stat.st_size, stat.st_mtime, sha, DONE)
+                continue
+            self.planned[file] = (stat.st_size, stat.st_mtime, sha)
+            todo[file] = row != None
+        self.db.commit()
+        return todo
+
+    def _record(self, file, size, mtime, sha, status, error=None):
+        self.db.execute(
+            "INSERT OR REPLACE INTO documents (path, size, mtime, sha256, status, error, updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (file, size, mtime, sha, status, error, time.time()))
+
+    # set the status of planned documents
+    def mark(self, files, status, error=None):
+        for file in files:
+            size, mtime, sha = self.planned[file]
+            self._record(file, size, mtime, sha, status, error)
+        self.db.commit()
@@ -0,0 +1,113 @@
+from MathMLLibrary.symbol_table import SymbolTable, SYMBOLS
+from array import array
+import networkx as nx
+
+
+
+"""
+CompactTree:
+    Purpose:
+        Array backed operator tree for ingestion & matching. Nodes are ints numbered in pre-order (the same ids
+        graphTree assigns), the structure is held in parent / first child / next sibling int arrays (-1 for none)
+        & each node's label is an id in a SymbolTable shared by every tree.
+    Input:
+        symbols (SymbolTable) - table interning the labels, the process wide SYMBOLS by default
+"""
+class CompactTree:
+    __slots__ = ("symbols", "label_ids", "parent", "first_child", "next_sibling")
+
+    def __init__(self, symbols=SYMBOLS):
+        self.symbols = symbols
+        self.label_ids = array('i')
+        self.parent = array('i')
+        self.first_child = array('i')
+        self.next_sibling = array('i')
+
+    def __len__(self):
+        return len(self.label_ids)
+
+    """
+    add_node:
+        Purpose:
+            Adds a node as the last child of parent, nodes must be added in pre-order to keep ids in pre-order.
+        Input:
+            label (str) - label of the node
+            parent (int) - id of the parent node, -1 for the root
+            prev_sibling (int) - id of parent's current last child if known, -1 to find it
+        Output:
+            int - id of the new node
+    """
+    def add_node(self, label, parent=-1, prev_sibling=-1):
+        node = len(self.label_ids)
+        self.label_ids.append(self.symbols.intern(label))
+        self.parent.append(parent)
+        self.first_child.append(-1)
+        self.next_sibling.append(-1)
+        if parent != -1:
+            if prev_sibling == -1 and self.first_child[parent] != -1:
+                prev_sibling = self.first_child[parent]
+                while self.next_sibling[prev_sibling] != -1:
+                    prev_sibling = self.next_sibling[prev_sibling]
+            if prev_sibling == -1:
+                self.first_child[parent] = node
+            else:
+                self.next_sibling[prev_sibling] = node
+        return node
+
+    # id of the root, -1 for an empty tree
+    @property
+    def root(self):
+        return 0 if len(self.label_ids) > 0 else -1
+
+    def label(self, node):
+        return self.symbols.symbols[self.label_ids[node]]
+
+    def is_leaf(self, node):
+        return self.first_child[node] == -1
+
+    def children(self, node):
+        child = self.first_child[node]
+        while child != -1:
+            yield child
+            child = self.next_sibling[child]
+
+    def num_children(self, node):
+        count = 0
+        child = self.first_child[node]
+        while child != -1:
+            count += 1
+            child = self.next_sibling[child]
+        return count
+
+    # node ids in breadth first order, children in order, the same order as nx.topological_sort of the tree
+    def bfs(self):
+        order = [] if len(self.label_ids) == 0 else [0]
+        for node in order:
+            child = self.first_child[node]
+            while child != -1:
+                order.append(child)
+                child = self.next_sibling[child]
+        return order
+
+    # NetworkX graph of the tree with the same node ids & 'data' attributes as graphTree, for plotting
+    def to_networkx(self):
+        G = nx.DiGraph()
+        for node in range(len(self.label_ids)):
+            G.add_node(node, data=self.label(node))
+            if self.parent[node] != -1:
+                G.add_edge(self.parent[node], node)
+        return G
+
+    # CompactTree of a NetworkX operator tree, nodes are renumbered in pre-order
+    @classmethod
+    def from_networkx(cls, G, symbols=SYMBOLS):
+        tree = cls(symbols)
+        roots = [node for node in G.nodes if G.in_degree(node) == 0]
+        stack = [(root, -1) for root in reversed(roots[:1])]
+        last_child = {}                     # Key: compact parent id, Value: compact id of its last added child
+        while stack:
+            node, parent = stack.pop()
+            new_id = tree.add_node(G.nodes[node]['data'], parent, last_child.get(parent, -1))
+            last_child[parent] = new_id
+            stack.extend((child, new_id) for child in reversed(list(G.successors(node))))
+        return tree
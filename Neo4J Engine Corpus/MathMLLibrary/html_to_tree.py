@@ -1,4 +1,7 @@
 from networkx.drawing.nx_agraph import graphviz_layout
+from MathMLLibrary.compact_tree import CompactTree
+from MathMLLibrary.symbol_table import SYMBOLS
+from MathMLLibrary.standardize_tree import standardizeOpTreeInPlace
 import matplotlib.font_manager as fm
 from functools import lru_cache
 import matplotlib.pyplot as plt
@@ -87,6 +90,54 @@ def toMathMLStrings(html_filename):
 
 
 
+"""
+iterEquations:
+    Purpose:
+        stream the block equations of an html document in a single parse, each <math> element is converted
+        to a mathML string & an operator tree as soon as it is parsed & then freed
+    Input:
+        html_filename (str) - article html filename
+        compact (bool) - yield CompactTree operator trees instead of nx graphs
+        standardize (bool) - rename variable leaves as standardizeOpTree does, while the tree is built
+    Output:
+        generator of (mathml string, latex alttext, nx graph or CompactTree of operator tree) for each "block" equation
+"""
+def iterEquations(html_filename, compact=False, standardize=False):
+    to_tree = compactTree if compact else graphTree
+    in_math = 0
+    with open(html_filename, "rb") as f:
+        for event, elem in ET.iterparse(f, events=("start", "end"), html=True, encoding="utf-8", recover=True):
+            if elem.tag == "math":
+                in_math += 1 if event == "start" else -1
+            if event == "start":
+                continue
+            if elem.tag == "math" and elem.get("display") == "block":
+                # remove unnecessary attributes
+                for child in elem.iterdescendants():
+                    for attr in REMOVE_ATTRIBUTES:
+                        child.attrib.pop(attr, None)
+                mathml_string = ET.tostring(elem, encoding="unicode", with_tail=False)
+                yield mathml_string, elem.get("alttext"), to_tree(toOpTree(elem), standardize=standardize)
+            # elements inside a math element are needed until the math element is finished
+            if in_math == 0:
+                elem.clear(keep_tail=False)
+
+
+
+"""
+getEquationsFromFile:
+    Purpose:
+        single pass replacement for calling toMathMLStrings & getTreesFromFile on the same file
+    Input:
+        html_filename (str) - article html filename
+    Output:
+        list of (mathml string, latex alttext, nx graph of operator tree) for each "block" equation
+"""
+def getEquationsFromFile(html_filename):
+    return list(iterEquations(html_filename))
+
+
+
 
 """
 subMissingGlyph:
@@ -164,18 +215,166 @@ class Node:
 
 
 
+"""
+_inOrderLabel:
+    Purpose:
+        flatten a small operator subtree into a single label, used when a subscript is compressed into its base
+    Input:
+        node (Node) - root of subtree with at most 2 children per node
+    Output:
+        str - in-order concatenation of the subtree's values joined by '_'
+"""
+def _inOrderLabel(node):
+    if node.children==[]:
+        return node.value.strip()
+    if len(node.children) == 2:
+        return _inOrderLabel(node.children[0]) + '_' + node.value + '_' + _inOrderLabel(node.children[1])
+    if len(node.children) == 1:
+        return _inOrderLabel(node.children[0]) + '_' + node.value
+
+
+
+"""
+_compressSubscript:
+    Purpose:
+        apply the subscript compression rules to an already converted subscript operator
+    Input:
+        et (etree) - subscript operator element
+        nodes (list[Node]) - converted children of et, nodes[0] is the subscript operator
+    Output:
+        compressed Node, or None if no rule applies & the subscript is kept as an operator
+
+    Rulbase for subscript compression:
+        Rule 0: tag1 ∈ {'ci', 'cn', 'cs'} ^ tag2 ∈ {'ci', 'cn', 'cs'} 
+                -> return Node(node1.value + '_' + node2.value)
+        Rule 1: node0.value == 'subscript' and node1.value == 'superscript' and node2.children == [] and node1.children[0].children == [] 
+                -> node1.children[0].value += '_' + node2.value; return node1
+        Rule 2: node0.value == 'subscript' and node1.children == [] 
+                -> return node1
+"""
+def _compressSubscript(et, nodes):
+    num_children = len(et)
+    compressable = {'ci', 'cn', 'cs'}
+    tag0, tag1 = et[0].tag, et[1].tag
+    node0, node1 = nodes[0], nodes[1]
+    # Apply Compression Rules
+    if num_children == 3:
+        tag2 = et[2].tag
+        node2 = nodes[2]
+        if tag1 in compressable and tag2 in compressable:
+            return Node(node1.value + '_' + node2.value)
+        elif node0.value == 'subscript' and node1.value == 'superscript' and node2.children == [] and node1.children[0].children == []:
+            node1.children[0].value += '_' + node2.value
+            return node1
+        elif node0.value == 'subscript' and node1.value == 'superscript' and node2.children !=[]:
+            return node1
+        elif node0.value == 'subscript' and node1.children == [] and tag1 in compressable and tag2 not in compressable:
+            node1.value += '_' + _inOrderLabel(node2) 
+            return node1
+        elif node0.value == 'subscript' and node1.children == []:
+            return node1
+        elif tag1 not in compressable and tag2 in compressable:
+            return node1
+        elif tag1 not in compressable and tag2 not in compressable:
+            return node1
+    return None
+
+
+
+"""
+_compressSuperscript:
+    Purpose:
+        apply the superscript compression rule to an uncompressed superscript operator
+    Input:
+        value (str) - operator value
+        children (list[Node]) - operator's children
+    Output:
+        compressed Node, or None if the rule doesn't apply
+
+    Rulbase for superscript compression:
+        Rule 0: uncompressed node has 3 children ^ all children are leaves 
+                -> move child[2] to be the child of child[0]
+"""
+def _compressSuperscript(value, children):
+    if len(children) == 3 and sum(len(child.children) for child in children) == 0:
+        operand = children[2]
+        operator = children[0]
+        power = children[1]
+        operator.children = [operand]
+        return Node(value, [operator, power])
+    return None
+
+
+
+"""
+_fixDerivatives:
+    Purpose:
+        attach the operand of a differential 'd' in a product to the 'd' node
+    Input:
+        value (str) - operator value ('times')
+        l1_nodes (list[Node]) - children of the uncompressed times operator
+    Output:
+        Node with derivatives fixed
+"""
+def _fixDerivatives(value, l1_nodes):
+    # convert d * operand to to d.child = operand
+    l1_removal = set()  
+    for l1_idx, l1 in enumerate(l1_nodes):
+        l1 = l1_nodes[l1_idx]
+        if l1_idx + 1 < len(l1_nodes):
+            if l1.value == '𝑑' and l1.children == []:
+                l1_child = l1_nodes[l1_idx + 1]
+                l1.children.append(l1_child)  
+                l1_removal.add(l1_idx + 1)  
+    new_l1 = []
+    for l1_idx, l1 in enumerate(l1_nodes):
+        if l1_idx not in l1_removal:
+            if l1.value == '𝑑':
+                l1.value = 'd'
+            new_l1.append(l1)
+
+    # convert times(superscript(d,n), z) to times(superscript(d(operant),n), z) if times has more children else superscript(d(operant),n).
+    l1_removal = set()  
+    for l1_idx, l1 in enumerate(l1_nodes):
+        l1 = l1_nodes[l1_idx]
+        if l1.value == 'superscript':
+            l2_nodes = l1.children
+            for l2_idx, l2 in enumerate(l2_nodes):
+                if l2.value == '𝑑' and l2.children == []:
+                    l2.value = 'd'
+                    if l1_idx + 1 < len(l1_nodes):
+                        l1_operand = l1_nodes[l1_idx + 1]
+                        l1_removal.add(l1_idx + 1)  
+                        l2.children = [l1_operand]
+                                      
+    new_l1 = []
+    for l1_idx, l1 in enumerate(l1_nodes):
+        if l1_idx not in l1_removal:
+            if l1.value == '𝑑':
+                l1.value = 'd'
+            new_l1.append(l1)
+
+    # times operator has only 1 child after compression
+    if len(new_l1) == 1:
+        return Node(new_l1[0].value, new_l1[0].children)
+    else:
+        return Node(value, new_l1)
+
+
+
 """
 toOpTree:
     Purpose:
-        convert a mathml_string into an operator tree
+        convert a mathml_string into an operator tree, every element is converted exactly once & the
+        compression rules are applied as rewrites of the already converted children
     Input:
-        mathml_string (str) - clean & readable mathML string
+        mathml_string (str) - clean & readable mathML string, or an already parsed etree <math> element
     Output:
         root of operator tree if string is valid, else None        
 """
 def toOpTree(mathml_string, compress_subscripts = True, compress_superscripts = True, fix_derivatives=True):
     # _eTreeToOpTree(et): converts etree xml object to node based operator tree
-    def _eTreeToOpTree(et, compress_subscripts = compress_subscripts, compress_superscripts = compress_superscripts,fix_derivatives=fix_derivatives ):
+    def _eTreeToOpTree(et):
         # Skip Tags: skip & process children
         if et.tag in skip:
             # "semantics" tag splits presentation & content ML
@@ -192,191 +391,41 @@ def toOpTree(mathml_string, compress_subscripts = True, compress_superscripts =
             
         # Terimal Tags: nested layers of tags before text
         elif et.tag in term:
-            value = et.text.strip()
+            value = (et.text or "").strip()
             while value == "": 
                 if len(list(et)) == 0:
                     value = "no text found"
                     break
                 et = et[0]
-                value = et.text.strip()
+                value = (et.text or "").strip()
             return Node(value = value)
 
         # Operator Tags: have operators & n children    
         elif et.tag in op:
-            value = ""
-            children = []
-            # first child of op tag is operator
-            node = _eTreeToOpTree(et[0]) 
+            # convert every child once, first child of op tag is operator, remaining children are operands
+            nodes = [_eTreeToOpTree(child) for child in et]
+            node = nodes[0]
             value = node.value 
 
-            '''
-            Rulbase for subscript compression:
-                Rule 0: tag1 ∈ {'ci', 'cn', 'cs'} ^ tag2 ∈ {'ci', 'cn', 'cs'} 
-                        -> return Node(node1.value + '_' + node2.value)
-                Rule 1: node0.value == 'subscript' and node1.value == 'superscript' and node2.children == [] and node1.children[0].children == [] 
-                        -> node1.children[0].value += '_' + node2.value; return node1
-                Rule 2: node0.value == 'subscript' and node1.children == [] 
-                        -> return node1
-            '''
             # compress subscript nodes into 1 node
-            if compress_subscripts == True:
-                num_children = len(et)
-                compressable = {'ci', 'cn', 'cs'}
-                if value=='subscript':
-                    tag0, tag1 = et[0].tag, et[1].tag
-                    node0, node1 = _eTreeToOpTree(et[0]), _eTreeToOpTree(et[1])
-                    # Apply Compression Rules
-                    if num_children == 3:
-                        tag2 = et[2].tag
-                        node2 = _eTreeToOpTree(et[2]) 
-                        if tag1 in compressable and tag2 in compressable:
-                            return Node(node1.value + '_' + node2.value)
-                        elif node0.value == 'subscript' and node1.value == 'superscript' and node2.children == [] and node1.children[0].children == []:
-                            node1.children[0].value += '_' + node2.value
-                            return node1
-                        elif node0.value == 'subscript' and node1.value == 'superscript' and node2.children !=[]:
-                            return node1
-                        elif node0.value == 'subscript' and node1.children == [] and tag1 in compressable and tag2 not in compressable:
-                            def _IOT(node):
-                                if node.children==[]:
-                                    return node.value.strip()
-                                if len(node.children) == 2:
-                                    return _IOT(node.children[0]) + '_' + node.value + '_' + _IOT(node.children[1])
-                                if len(node.children) == 1:
-                                    return _IOT(node.children[0]) + '_' + node.value
-                                
-                            node1.value += '_' + _IOT(node2) 
-                            return node1
-                        elif node0.value == 'subscript' and node1.children == []:
-                            return node1
-                        elif tag1 not in compressable and tag2 in compressable:
-                            return node1
-                        elif tag1 not in compressable and tag2 not in compressable:
-                            return node1
-
-            # compress superscript nodes
-            if compress_superscripts == True:
-                if value == 'superscript':
-                    '''
-                    Rulbase for superscript compression:
-                        Rule 0: test = opTree(et) w/o super-script compression 3 ^ all children are of test are leaves 
-                                -> move test.child[2] to be the child of test.child[1]
-                    '''
-                    test_node = _eTreeToOpTree(et, compress_subscripts, False)
-                    if len(test_node.children) == 3 and sum(len(child.children) for child in test_node.children) == 0:
-                        operand = test_node.children[2]
-                        operator = test_node.children[0]
-                        power = test_node.children[1]
-                        operator.children = [operand]
-                        return Node(value, [operator, power])
-                    
-
-
-            if fix_derivatives == True:
-                if value == 'times':
-                    l0 = _eTreeToOpTree(et, compress_subscripts, compress_superscripts, False)
-        
-                    # convert d * operand to to d.child = operand
-                    l1_removal = set()  
-                    l1_nodes = l0.children
-                    for l1_idx, l1 in enumerate(l1_nodes):
-                        l1 = l1_nodes[l1_idx]
-                        if l1_idx + 1 < len(l1_nodes):
-                            if l1.value == '𝑑' and l1.children == []:
-                                l1_child = l1_nodes[l1_idx + 1]
-                                l1.children.append(l1_child)  
-                                l1_removal.add(l1_idx + 1)  
-                    new_l1 = []
-                    for l1_idx, l1 in enumerate(l1_nodes):
-                        if l1_idx not in l1_removal:
-                            if l1.value == '𝑑':
-                                l1.value = 'd'
-                            new_l1.append(l1)
-
-
-                # convert times(superscript(d,n), z) to times(superscript(d(operant),n), z) if times has more children else superscript(d(operant),n).
-                    l1_removal = set()  
-                    l1_nodes = l0.children
-                    for l1_idx, l1 in enumerate(l1_nodes):
-                        l1 = l1_nodes[l1_idx]
-                        if l1.value == 'superscript':
-                            l2_nodes = l1.children
-                            for l2_idx, l2 in enumerate(l2_nodes):
-                                if l2.value == '𝑑' and l2.children == []:
-                                    l2.value = 'd'
-                                    if l1_idx + 1 < len(l1_nodes):
-                                        l1_operand = l1_nodes[l1_idx + 1]
-                                        l1_removal.add(l1_idx + 1)  
-                                        l2.children = [l1_operand]
-                                                      
-                    new_l1 = []
-                    for l1_idx, l1 in enumerate(l1_nodes):
-                        if l1_idx not in l1_removal:
-                            if l1.value == '𝑑':
-                                l1.value = 'd'
-                            new_l1.append(l1)
-
-                    # times operator has only 1 child after compression
-                    if len(new_l1) == 1:
-                        return Node(new_l1[0].value, new_l1[0].children)
-                    else:
-                        return Node(value, new_l1)
-                
-                
-
-
-                        
-                    
-                    
-                        
-             
-
-                        # if l1.value == 'superscript':
-                        #     l0.children.remove(l1_idx+1)
-
-                        # # Case 0: d*var 
-                        # if l1.value == 'd' and l1.children == []:
-                        #     new_children = l0
-
-
-
-                        # if l1.value == 'superscript':
-                        #     for l2_idx,l2 in enumerate(l1.children):
-                        #         if l2.ch
-
-
-
-
-                
-
-      
-                    
-                      
-
-
-
-
-
-
-
-                           
-
-
-
-
-
-
-                        
+            if compress_subscripts == True and value == 'subscript':
+                compressed = _compressSubscript(et, nodes)
+                if compressed != None:
+                    return compressed
 
+            # operator's children become children of operator node, operands are the remaining children
+            children = node.children + nodes[1:]
 
+            # compress superscript nodes
+            if compress_superscripts == True and value == 'superscript':
+                compressed = _compressSuperscript(value, children)
+                if compressed != None:
+                    return compressed
 
+            # attach derivative operands to 'd'
+            if fix_derivatives == True and value == 'times':
+                return _fixDerivatives(value, children)
 
- 
-            # operator's children become children of operator node
-            children.extend(node.children) 
-            # remaining children are operands & become children of operator node
-            for i in range(1, len(list(et))): 
-                children.append(_eTreeToOpTree(et[i]))
             return Node(value = value.strip(), children = children)
 
         # No Children Tags: return Node with value = tag
@@ -392,7 +441,10 @@ def toOpTree(mathml_string, compress_subscripts = True, compress_superscripts =
         
     # Attempt to create operator tree
     try:        
-        et = ET.fromstring(mathml_string.encode('utf-8'))
+        if isinstance(mathml_string, str):
+            et = ET.fromstring(mathml_string.encode('utf-8'))
+        else:
+            et = mathml_string
         root = _eTreeToOpTree(et)
         return root
     except ET.XMLSyntaxError as e:
@@ -407,10 +459,11 @@ graphTree:
         convert a Node* based tree to a graphable networkX object
     Input:
         root (Node*): root of contentML Tree
+        standardize (bool): rename variable leaves in place as standardizeOpTree does, instead of copying the graph
     Output:
         G (DiGraph) plottable by networkX
 """
-def graphTree(root):
+def graphTree(root, standardize=False):
     # populates G with a Node* to the root of a content ML tree, & node's parent id
     def _graphTree(G, node, parent_id):
         if node == None:
@@ -433,10 +486,45 @@ def graphTree(root):
     # Generate Network X Tree to Plot        
     G = nx.DiGraph()
     _graphTree(G, root, -1)
+    if standardize:
+        standardizeOpTreeInPlace(G)
     return G
 
 
 
+"""
+compactTree:
+    Purpose:
+        convert a Node* based tree to a CompactTree, without the networkX graph built by graphTree.
+        node ids & labels are the same as graphTree's, but the Node* tree isn't modified
+    Input:
+        root (Node*): root of contentML Tree
+        symbols (SymbolTable): table the labels are interned in
+        standardize (bool): rename variable leaves as standardizeOpTree does
+    Output:
+        CompactTree of the operator tree, empty if root is None
+"""
+def compactTree(root, symbols=SYMBOLS, standardize=False):
+    tree = CompactTree(symbols)
+    if root == None:
+        return tree
+    stack = [(root, -1)]
+    last_child = {}                         # Key: parent id, Value: id of its last added child
+    while stack:
+        node, parent_id = stack.pop()
+        value = node.value
+        if len(node.children) == 0:
+            # renderable label, as in graphTree
+            value = "".join(subMissingGlyph(char) for char in node.value)
+        node_id = tree.add_node(value, parent_id, last_child.get(parent_id, -1))
+        last_child[parent_id] = node_id
+        stack.extend((child, node_id) for child in reversed(node.children) if child != None)
+    if standardize:
+        standardizeOpTreeInPlace(tree)
+    return tree
+
+
+
 """
 getTreesFromFile:
     Purpose: 
@@ -447,13 +535,7 @@ getTreesFromFile:
         list of nx graph objects, ready to plot
 """
 def getTreesFromFile(filename):
-    trees = []
-    mathml_strings = toMathMLStrings(filename)
-    for i, e in enumerate(mathml_strings): 
-        root = toOpTree(e[0])
-        G = graphTree(root)
-        trees.append(G)
-    return trees
+    return [G for mathml_string, latex_string, G in iterEquations(filename)]
 ######################################################################################################################################
 
 
@@ -586,12 +668,8 @@ plotTreesFromFile:
         None - 1 by 1 graphs of contentML equations
 """
 def plotTreesFromFile(filename):
-    mathml_strings = toMathMLStrings(filename)
-    for i, e in enumerate(mathml_strings): 
-        math_str, latex_str = e[0], e[1]
-        root = toOpTree(math_str)
-        title = cleanUpLatex(e[1])
-        G = graphTree(root)
+    for math_str, latex_str, G in iterEquations(filename): 
+        title = cleanUpLatex(latex_str)
         plotTree(G, title)
 
 
@@ -1,4 +1,8 @@
+from MathMLLibrary.compact_tree import CompactTree
+from collections import OrderedDict
+from array import array
 import networkx as nx
+import numpy as np
 """
 extractFeatures:
     Purpose:
@@ -63,8 +67,317 @@ def extractFeatures(t):
             features.append([vars, operators])
     return features
 
+
+
+"""
+extractFeaturesFromRootPaths:
+    Purpose:
+        Same output as extractFeatures, but each root-to-leaf path is computed once in a single breadth first
+        walk & the operator path between two leaves is read off their root paths below the lowest common ancestor,
+        instead of running two shortest path searches & a list merge for every pair of leaves.
+    Input:
+        t (nx.DiGraph) - NetworkX directed graph object representing the tree. Each node should 
+        have an associated 'data' attribute that can be an operator or variable.
+    Output:
+        features (List[Tuple]) - A list of features, identical to the output of extractFeatures.
+"""
+def extractFeaturesFromRootPaths(t):
+    # find root of tree
+    root = None
+    for node in t.nodes:
+        if t.in_degree(node) == 0:
+            root = node
+            break
+    if root == None:
+        return []
+
+    # breadth first walk from the root, leaves are found in the same order as topological_sort
+    # root_paths[leaf] = node ids from the root to the leaf, root_labels[leaf] = their 'data' attributes
+    parent = {root: None}
+    var_nodes = []
+    frontier = [root]
+    while frontier:
+        next_frontier = []
+        for node in frontier:
+            children = list(t.successors(node))
+            if children == []:
+                var_nodes.append(node)
+            for child in children:
+                parent[child] = node
+                next_frontier.append(child)
+        frontier = next_frontier
+
+    root_paths, root_labels = [], []
+    for leaf in var_nodes:
+        path = []
+        node = leaf
+        while node != None:
+            path.append(node)
+            node = parent[node]
+        path.reverse()
+        root_paths.append(path)
+        root_labels.append([t.nodes[node]['data'] for node in path])
+    return _leafPairFeatures(root_paths, root_labels)
+
+
+
+# features of every pair of leaves given their root to leaf paths of node ids & labels, leaves in breadth first order
+def _leafPairFeatures(root_paths, root_labels):
+    features = []
+    # for every pair of possible leaf nodes
+    for i in range(len(root_paths)):
+        path_a, labels_a = root_paths[i], root_labels[i]
+        for j in range(i+1, len(root_paths)):
+            path_b, labels_b = root_paths[j], root_labels[j]
+
+            # k = index of the first node below the lowest common ancestor (path_a[k-1])
+            k = 1
+            while k < len(path_a) and k < len(path_b) and path_a[k] == path_b[k]:
+                k += 1
+
+            # operators from leaf a up to the common ancestor & back down to leaf b, leaves excluded
+            operators = labels_a[len(labels_a)-2:k-1:-1] + [labels_a[k-1]] + labels_b[k:len(labels_b)-1]
+
+            # list[0] = (var1, var2), list[1] = operators
+            vars = (labels_a[-1], labels_b[-1])
+            features.append([vars, operators])
+    return features
+
+"""
+extractFeaturesFromCompactTree:
+    Purpose:
+        extractFeaturesFromRootPaths for a CompactTree, root paths are read off the parent array.
+    Input:
+        t (CompactTree) - operator tree.
+        codes (bool) - Label features with the tree's symbol ids instead of label strings.
+    Output:
+        features (List[Tuple]) - A list of features, identical to extractFeaturesFromRootPaths of the same tree.
+"""
+def extractFeaturesFromCompactTree(t, codes=False):
+    root_paths, root_labels = [], []
+    for leaf in t.bfs():
+        if not t.is_leaf(leaf):
+            continue
+        path = []
+        node = leaf
+        while node != -1:
+            path.append(node)
+            node = t.parent[node]
+        path.reverse()
+        root_paths.append(path)
+        if codes:
+            root_labels.append([t.label_ids[node] for node in path])
+        else:
+            root_labels.append([t.label(node) for node in path])
+    return _leafPairFeatures(root_paths, root_labels)
+
 # disregard variable node names, only return the corresponding operator paths between children
-get_features = lambda tree : [tuple(feature_path) for children, feature_path in extractFeatures(tree)]
+get_features = lambda tree : [tuple(feature_path) for children, feature_path in
+                              (extractFeaturesFromCompactTree(tree) if isinstance(tree, CompactTree) else extractFeaturesFromRootPaths(tree))]
+
+# operator paths of a CompactTree as tuples of symbol ids, decode them with tree.symbols.decode
+get_feature_codes = lambda tree : [tuple(feature_path) for children, feature_path in extractFeaturesFromCompactTree(tree, codes=True)]
+
+
+
+"""
+FeatureCache:
+    Purpose:
+        LRU cache of the partial features of subtrees, keyed by the subtree itself as nested tuples of symbol ids, so a
+        sub-expression shared by many equations has its leaf pair features computed once per process.
+        an entry holds the subtree's leaves & the features whose leaves meet inside it, see extractFeatureCodesMemoized.
+        the cache is bounded by the number of leaf pair features reachable from its entries, rather than by the
+        number of entries, since a subtree with L leaves holds L*(L-1)/2 of them. hits & misses are counted so the
+        hit rate can be monitored, along with the equations too small to be worth memoizing
+    Input:
+        max_features (int) - max number of features & leaves held, least recently used subtrees are evicted first
+        max_leaves (int) - subtrees with more leaves than this are never cached
+        min_leaves (int) - equations with fewer leaves than this are extracted by get_feature_codes, building the
+                           subtree keys of a small equation costs more than composing its cached subtrees saves
+        symbols (SymbolTable) - table of the symbol ids in cached features, trees using another table aren't cached
+"""
+class FeatureCache:
+    def __init__(self, max_features=250000, max_leaves=32, min_leaves=24, symbols=None):
+        self.max_features = max_features
+        self.max_leaves = max_leaves
+        self.min_leaves = min_leaves
+        self.symbols = symbols
+        self.entries = OrderedDict()        # Key: (label id, child keys...), Value: (size, entry)
+        self.num_features = 0               # sum of the sizes of the cached entries
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0                    # equations extracted without the cache, having fewer than min_leaves leaves
+
+    # cached entry of a subtree, None if it isn't cached
+    def get(self, key):
+        cached = self.entries.get(key)
+        if cached == None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return cached[1]
+
+    def put(self, key, entry):
+        num_leaves = len(entry[0])
+        size = num_leaves * (num_leaves - 1) // 2 + num_leaves
+        if size > self.max_features:
+            return
+        if key in self.entries:
+            self.num_features -= self.entries.pop(key)[0]
+        self.entries[key] = (size, entry)
+        self.num_features += size
+        while self.num_features > self.max_features:
+            self.num_features -= self.entries.popitem(last=False)[1][0]
+
+    def clear(self):
+        self.entries.clear()
+        self.num_features = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": len(self.entries), "num_features": self.num_features, "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0, "skipped": self.skipped}
+
+# cache used by the ingestion path, one per process, a cached feature takes about 120 bytes
+FEATURE_CACHE = FeatureCache()
+
+
+
+"""
+extractFeatureCodesMemoized:
+    Purpose:
+        get_feature_codes of a CompactTree composed bottom up from cached subtree results. the entry of a subtree is
+            leaves - (depth below the subtree root, operators from the root down to the leaf's parent,
+                      the same operators upwards) for each leaf, left to right
+            child entries - (index of the child's first leaf, entry) for each child
+            features - (first leaf, second leaf, operators) for the leaf pairs whose lowest common ancestor is the root
+        so a parent only computes the features between leaves of different children & reuses every child's entry.
+        features are oriented & ordered by the breadth first rank of their leaves, as in extractFeaturesFromRootPaths.
+        only proper subtrees with at most cache.max_leaves leaves are looked up & stored, whole equations are
+        cached by extract_document. equations with fewer than cache.min_leaves leaves go straight to get_feature_codes
+    Input:
+        t (CompactTree) - operator tree.
+        cache (FeatureCache) - subtree cache, FEATURE_CACHE by default
+    Output:
+        features (List[Tuple]) - operator paths as tuples of symbol ids, identical to get_feature_codes(t)
+"""
+def extractFeatureCodesMemoized(t, cache=FEATURE_CACHE):
+    if cache.symbols == None:
+        cache.symbols = t.symbols
+    if cache.symbols is not t.symbols or len(t) == 0:
+        return get_feature_codes(t)
+    if t.first_child.count(-1) < cache.min_leaves:
+        cache.skipped += 1
+        return get_feature_codes(t)
+
+    keys, entries, num_leaves = {}, {}, {}
+    # children are visited before their parent in reverse pre-order
+    for node in range(len(t) - 1, -1, -1):
+        if t.is_leaf(node):
+            keys[node] = (t.label_ids[node],)
+            entries[node] = _LEAF_ENTRY
+            num_leaves[node] = 1
+            continue
+        children = list(t.children(node))
+        key = keys[node] = (t.label_ids[node],) + tuple(keys.pop(child) for child in children)
+        num_leaves[node] = sum(num_leaves.pop(child) for child in children)
+        cacheable = node != t.root and num_leaves[node] <= cache.max_leaves
+        entry = cache.get(key) if cacheable else None
+        if entry == None:
+            entry = _composeFeatureEntry(t.label_ids[node], [entries[child] for child in children])
+            if cacheable:
+                cache.put(key, entry)
+        for child in children:
+            del entries[child]
+        entries[node] = entry
+
+    # breadth first rank of each leaf, leaves at equal depth stay in left to right order
+    leaves = entries[t.root][0]
+    rank = [0] * len(leaves)
+    for r, leaf in enumerate(sorted(range(len(leaves)), key=lambda leaf: leaves[leaf][0])):
+        rank[leaf] = r
+
+    features = []
+    stack = [(0, entries[t.root])]
+    while stack:
+        offset, (_, child_entries, pair_features) = stack.pop()
+        features.extend((rank[offset + a], rank[offset + b], operators) for a, b, operators in pair_features)
+        stack.extend((offset + first_leaf, child) for first_leaf, child in child_entries)
+    features.sort(key=lambda feature: (feature[0], feature[1]))
+    return [operators for a, b, operators in features]
+
+# entry of a single leaf, it has no features
+_LEAF_ENTRY = (((0, (), ()),), (), ())
+
+# entry of a subtree whose root is labelled label_id given the entries of its children, left to right
+def _composeFeatureEntry(label_id, child_entries):
+    leaves, offsets = [], []
+    for child_leaves, _, _ in child_entries:
+        offsets.append(len(leaves))
+        leaves.extend((depth + 1, (label_id,) + down, up + (label_id,)) for depth, down, up in child_leaves)
+
+    # a pair of leaves under different children meets at this root, the leaf first in breadth first order,
+    # the shallower one or else the left one, is the start of the operator path
+    features = []
+    for i in range(len(child_entries)):
+        leaves_a = child_entries[i][0]
+        for j in range(i+1, len(child_entries)):
+            leaves_b = child_entries[j][0]
+            for a, (depth_a, down_a, up_a) in enumerate(leaves_a, offsets[i]):
+                for b, (depth_b, down_b, up_b) in enumerate(leaves_b, offsets[j]):
+                    if depth_a <= depth_b:
+                        features.append((a, b, up_a + (label_id,) + down_b))
+                    else:
+                        features.append((b, a, up_b + (label_id,) + down_a))
+    return tuple(leaves), tuple(zip(offsets, child_entries)), tuple(features)
+
+
+
+"""
+equation_statistics:
+    Purpose:
+        Computes the size statistics stored with each equation at ingestion, used as ranking denominators & size filters.
+    Input:
+        tree (nx.DiGraph or CompactTree) - operator tree of the equation
+        features (List[Tuple]) - features of the tree, as returned by get_features
+    Output:
+        dict - num_features (distinct features), num_operators (distinct operator labels), num_leaves &
+               depth (number of edges on the longest root to leaf path)
+"""
+def equation_statistics(tree, features):
+    if isinstance(tree, CompactTree):
+        return _compact_equation_statistics(tree, features)
+    operators = set()
+    num_leaves = 0
+    for node in tree.nodes:
+        if tree.out_degree(node) == 0:
+            num_leaves += 1
+        else:
+            operators.add(tree.nodes[node]['data'])
+
+    # walk the tree one level at a time from its root
+    depth = -1
+    level = [node for node in tree.nodes if tree.in_degree(node) == 0]
+    while level:
+        depth += 1
+        level = [child for node in level for child in tree.successors(node)]
+
+    return {"num_features": len(set(features)), "num_operators": len(operators), "num_leaves": num_leaves, "depth": max(depth, 0)}
+
+# equation_statistics of a CompactTree, parents precede their children in pre-order so depths take one pass
+def _compact_equation_statistics(tree, features):
+    operators = set()
+    num_leaves = 0
+    depths = array('i')
+    for node in range(len(tree)):
+        parent = tree.parent[node]
+        depths.append(0 if parent == -1 else depths[parent] + 1)
+        if tree.is_leaf(node):
+            num_leaves += 1
+        else:
+            operators.add(tree.label_ids[node])
+    return {"num_features": len(set(features)), "num_operators": len(operators), "num_leaves": num_leaves, "depth": max(depths, default=0)}
 
 
 """
@@ -90,29 +403,48 @@ def printFeatures(features):
 
 
 """
-get_feature_subsets:
+iter_feature_subsets:
     Purpose:
-        Generates all possible subsets of the given feature, including the empty set.
+        Lazily generates the distinct subsets (subsequences) of the given feature, longest and so most selective
+        first. Repeated operators don't produce duplicate subsets & only the subsets that are consumed are ever
+        built, so the 2^N subsets of a long feature are never all held in memory.
     Input:
-        feature (list) - A list of elements for which all subsets are to be generated.
+        feature (list) - A list of elements for which subsets are to be generated.
+        min_len (int) - Shortest subset generated, 0 includes the empty set.
+        max_len (int) - Longest subset generated, None for the length of feature.
+        limit (int) - Max number of subsets generated, None for no limit.
     Output:
-        list - A list containing all possible subsets of the input feature, including
-               the empty set. Each subset is represented as a list.
+        generator - Distinct subsets as tuples, by decreasing length then by position in feature.
 """
-def get_feature_subsets(feature):
-    # S(i) generates all subsets of feature[i...N]
-    N = len(feature) 
-    def S(i):
-        if i==N-1:
-            return [[feature[N-1]], []]
-        to_ret = []
-        for subset in S(i+1):
-            include = [feature[i]] +  subset
-            exclude = subset
-            to_ret.append(include)
-            to_ret.append(exclude)
-        return to_ret
-    return(S(0))
+def iter_feature_subsets(feature, min_len=1, max_len=None, limit=None):
+    N = len(feature)
+    if max_len == None or max_len > N:
+        max_len = N
+    # next_occurrence[i] maps each element to the first index >= i holding it, in order of that index
+    next_occurrence = [{} for _ in range(N + 1)]
+    for i in range(N - 1, -1, -1):
+        next_occurrence[i] = {feature[i]: i}
+        for element, j in next_occurrence[i + 1].items():
+            if element != feature[i]:
+                next_occurrence[i][element] = j
+
+    # subsets of length `length` of feature[i...N], each embedded at its leftmost occurrence so it is generated once
+    def subsets(i, length):
+        if length == 0:
+            yield ()
+            return
+        for element, j in next_occurrence[i].items():
+            if N - j >= length:
+                for rest in subsets(j + 1, length - 1):
+                    yield (element,) + rest
+
+    count = 0
+    for length in range(max_len, min_len - 1, -1):
+        for subset in subsets(0, length):
+            if limit != None and count >= limit:
+                return
+            count += 1
+            yield subset
 
 
 
@@ -129,14 +461,59 @@ is_subsequence:
 """
 def is_subsequence(S, F):
     N = len(S)
-    M = len(F)
-    def _is_subsequence(i, j):
+    i = 0
+    # greedily match the next element of S against each element of F in turn
+    for item in F:
         if i == N:
-            return True
-        if j == M:
-            return False
-        if S[i] == F[j]:
-            return _is_subsequence(i+1, j+1)
-        if  S[i] != F[j]:
-            return _is_subsequence(i, j+1)
-    return _is_subsequence(0, 0)
\ No newline at end of file
+            break
+        if S[i] == item:
+            i += 1
+    return i == N
+
+
+
+"""
+encode_paths:
+    Purpose:
+        Packs feature paths into a padded matrix of integer operator codes for is_subsequence_bulk.
+    Input:
+        paths (list[list]) - Feature paths, e.g. the operators of every stored feature.
+        codes (dict) - Operator -> integer code, operators not in it are added. A new dict is made if None.
+    Output:
+        (np.ndarray, dict) - int32 matrix with one row per path padded with -1, and the operator codes.
+"""
+def encode_paths(paths, codes=None):
+    if codes == None:
+        codes = {}
+    width = max((len(path) for path in paths), default=0)
+    matrix = np.full((len(paths), width), -1, dtype=np.int32)
+    for row, path in enumerate(paths):
+        matrix[row, :len(path)] = [codes.setdefault(operator, len(codes)) for operator in path]
+    return matrix, codes
+
+
+
+"""
+is_subsequence_bulk:
+    Purpose:
+        Vectorized is_subsequence of one pattern against many feature paths, the two pointer scan of every path
+        advances together one column of the path matrix at a time.
+    Input:
+        S (list) - Sequence to be verified as a subsequence.
+        matrix (np.ndarray) - Paths encoded by encode_paths.
+        codes (dict) - Operator codes used to encode matrix.
+    Output:
+        np.ndarray - bool per row of matrix, True if `S` is a subsequence of that path.
+"""
+def is_subsequence_bulk(S, matrix, codes):
+    N = len(S)
+    if N == 0:
+        return np.ones(len(matrix), dtype=bool)
+    if any(operator not in codes for operator in S):
+        return np.zeros(len(matrix), dtype=bool)
+    # pattern codes with a sentinel after the last element that no path column matches
+    pattern = np.array([codes[operator] for operator in S] + [-2], dtype=np.int32)
+    matched = np.zeros(len(matrix), dtype=np.intp)     # number of elements of S matched so far in each path
+    for column in matrix.T:
+        matched += column == pattern[matched]
+    return matched == N
\ No newline at end of file
@@ -1,3 +1,4 @@
+from MathMLLibrary.compact_tree import CompactTree
 import networkx as nx
 
 # list of common constants in hex
@@ -70,4 +71,42 @@ def standardizeOpTree(t):
             idx += 1
     
     # return standardized opTree
-    return s
\ No newline at end of file
+    return s
+
+
+
+"""
+standardizeOpTreeInPlace:
+    Purpose:
+        Same renaming as standardizeOpTree, but the variable leaves of t are renamed in place during a single
+        breadth first walk from the root, without copying the tree or sorting it topologically.
+    Input:
+        t (nx.DiGraph or CompactTree) - operation tree with a single root, as built by graphTree or compactTree.
+    Output:
+        t - the same tree with standardized variable names.
+"""
+def standardizeOpTreeInPlace(t):
+    if isinstance(t, CompactTree):
+        return _standardizeCompactTree(t)
+    substitutions = {}
+    frontier = [node for node in t.nodes if t.in_degree(node) == 0]
+    for node in frontier:
+        children = list(t.successors(node))
+        frontier.extend(children)
+        if children == [] and isVar(t.nodes[node]['data']):
+            t.nodes[node]['data'] = _substitute(substitutions, t.nodes[node]['data'])
+    return t
+
+# standardizeOpTreeInPlace of a CompactTree, renamed leaves point to the symbol ids of their new names
+def _standardizeCompactTree(t):
+    substitutions = {}
+    for node in t.bfs():
+        if t.is_leaf(node) and isVar(t.label(node)):
+            t.label_ids[node] = t.symbols.intern(_substitute(substitutions, t.label(node)))
+    return t
+
+# standardized name of a variable, variables are named 'a', 'b', ... in order of first appearance
+def _substitute(substitutions, name):
+    if name not in substitutions:
+        substitutions[name] = chr(ord('a') + len(substitutions))
+    return substitutions[name]
@@ -0,0 +1,66 @@
+import json
+
+
+
+"""
+SymbolTable:
+    Purpose:
+        interns operator & leaf labels as small ints so trees & feature paths can be stored as int arrays & tuples.
+        ids are assigned in order of first use & never change, so a table saved with an index keeps its meaning
+    Input:
+        symbols (list[str]) - labels of ids 0, 1, ..., e.g. a previously saved table
+"""
+class SymbolTable:
+    __slots__ = ("symbols", "ids")
+
+    def __init__(self, symbols=None):
+        self.symbols = [] if symbols == None else list(symbols)     # id -> label
+        self.ids = {label: i for i, label in enumerate(self.symbols)}  # label -> id
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def __contains__(self, label):
+        return label in self.ids
+
+    # id of label, added to the table if it is new
+    def intern(self, label):
+        i = self.ids.get(label)
+        if i == None:
+            i = self.ids[label] = len(self.symbols)
+            self.symbols.append(label)
+        return i
+
+    # id of label, None if it isn't in the table
+    def lookup(self, label):
+        return self.ids.get(label)
+
+    def label(self, i):
+        return self.symbols[i]
+
+    # ids of a sequence of labels, new labels are added to the table
+    def encode(self, labels):
+        return tuple(self.intern(label) for label in labels)
+
+    # ids of a sequence of labels without adding to the table, None if any label is unknown
+    def encode_known(self, labels):
+        ids = tuple(self.ids.get(label) for label in labels)
+        return None if None in ids else ids
+
+    def decode(self, ids):
+        return tuple(self.symbols[i] for i in ids)
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.symbols, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            return cls(json.load(f))
+
+
+
+# process wide table used by the tree builders & feature extractor, ids are only meaningful within this process
+# unless the table is saved, so labels are decoded before results leave a worker process
+SYMBOLS = SymbolTable()
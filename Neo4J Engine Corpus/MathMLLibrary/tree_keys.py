@@ -0,0 +1,101 @@
+from MathMLLibrary.compact_tree import CompactTree
+import hashlib
+
+# number of bytes in a key, keys are stored as 2*KEY_BYTES hex characters
+KEY_BYTES = 16
+# operators whose operands can be reordered without changing the equation, their children are sorted by equation_fingerprint
+COMMUTATIVE_OPERATORS = frozenset(["plus", "times", "eq", "neq", "approx", "and", "or", "set", "union", "intersect"])
+
+
+
+# length prefixed encoding of a label so that no two label sequences serialize to the same bytes
+def _token(label, num_children=0):
+    label = str(label).encode('utf-8')
+    return str(len(label)).encode('ascii') + b':' + label + b'/' + str(num_children).encode('ascii') + b';'
+
+
+
+"""
+equation_key:
+    Purpose:
+        compute a fixed width key for an operator tree by hashing its canonical pre-order serialization,
+        structurally identical trees always get the same key
+    Input:
+        tree (nx.DiGraph) - operator tree from graphTree, node labels are stored in the 'data' attribute,
+                            or a CompactTree whose node ids are already in pre-order
+    Output:
+        str - hex digest identifying the tree
+"""
+def equation_key(tree):
+    h = hashlib.blake2b(digest_size=KEY_BYTES)
+    if isinstance(tree, CompactTree):
+        for node in range(len(tree)):
+            h.update(_token(tree.label(node), tree.num_children(node)))
+        return h.hexdigest()
+    roots = [node for node in tree.nodes if tree.in_degree(node) == 0]
+    stack = list(reversed(roots))
+    while stack:
+        node = stack.pop()
+        children = list(tree.successors(node))
+        h.update(_token(tree.nodes[node]['data'], len(children)))
+        stack.extend(reversed(children))
+    return h.hexdigest()
+
+
+
+"""
+feature_key:
+    Purpose:
+        compute a fixed width key for a feature path
+    Input:
+        feature (tuple[str]) - operators on the path between two leaves, as returned by get_features
+    Output:
+        str - hex digest identifying the feature path
+"""
+def feature_key(feature):
+    h = hashlib.blake2b(digest_size=KEY_BYTES)
+    for operator in feature:
+        h.update(_token(operator))
+    return h.hexdigest()
+
+
+
+"""
+equation_fingerprint:
+    Purpose:
+        compute a canonical structural key for an operator tree as a Merkle hash, each node's digest covers its label
+        & its children's digests, which are sorted under commutative operators. trees that only differ in the order
+        of commutative operands get the same fingerprint
+    Input:
+        tree (nx.DiGraph or CompactTree) - operator tree, standardize it first to also ignore variable names
+        commutative (set[str]) - labels of commutative operators
+    Output:
+        str - hex digest identifying the tree up to reordering of commutative operands
+"""
+def equation_fingerprint(tree, commutative=COMMUTATIVE_OPERATORS):
+    if isinstance(tree, CompactTree):
+        preorder = range(len(tree))
+        label, children = tree.label, tree.children
+    else:
+        roots = [node for node in tree.nodes if tree.in_degree(node) == 0]
+        preorder, stack = [], list(reversed(roots))
+        while stack:
+            node = stack.pop()
+            preorder.append(node)
+            stack.extend(reversed(list(tree.successors(node))))
+        label, children = (lambda node: tree.nodes[node]['data']), tree.successors
+
+    # children are visited before their parent in reverse pre-order
+    digests = {}
+    for node in reversed(preorder):
+        child_digests = [digests.pop(child) for child in children(node)]
+        if label(node) in commutative:
+            child_digests.sort()
+        h = hashlib.blake2b(digest_size=KEY_BYTES)
+        h.update(_token(label(node), len(child_digests)))
+        for digest in child_digests:
+            h.update(digest)
+        digests[node] = h.digest()
+    if len(preorder) == 0:
+        return hashlib.blake2b(digest_size=KEY_BYTES).hexdigest()
+    return digests[preorder[0]].hex()
@@ -0,0 +1,508 @@
+from MathMLLibrary.pull_features import *
+from MathMLLibrary.tree_keys import *
+from MathMLLibrary.symbol_table import *
+from CorpusPipeline import *
+from bisect import bisect_left
+from array import array
+import numpy as np
+import itertools
+import heapq
+import math
+import argparse
+import json
+import mmap
+import os
+
+# index files, all arrays are native unsigned ints written with array.tofile
+META_FILE = "meta.json"
+FEATURES_FILE = "features.json"             # [feature key, operator symbol ids] for every feature id
+POSTINGS_FILE = "postings.bin"              # uint32 equation ids, sorted per feature
+POSTINGS_IDX_FILE = "postings.idx"          # uint64 offsets into postings.bin, feature id i -> [idx[i], idx[i+1])
+POSTINGS_TF_FILE = "postings_tf.bin"        # uint32 tf of the feature in each posting, parallel to postings.bin
+EQ_FEATURES_FILE = "eq_features.bin"        # uint32 feature ids of every equation
+EQ_FEATURES_IDX_FILE = "eq_features.idx"    # uint64 offsets into eq_features.bin
+EQUATIONS_FILE = "equations.jsonl"          # one json record per equation id
+EQUATIONS_IDX_FILE = "equations.idx"        # uint64 byte offsets of each record in equations.jsonl
+SYMBOLS_FILE = "symbols.json"               # SymbolTable of the operator labels, label of every symbol id
+OP_POSTINGS_FILE = "op_postings.bin"        # uint32 feature ids, sorted per operator symbol id
+OP_POSTINGS_IDX_FILE = "op_postings.idx"    # uint64 offsets into op_postings.bin
+EQ_STATS_FILE = "eq_stats.bin"              # uint32 EQ_STATS values of every equation, equation id i -> [i*len(EQ_STATS), (i+1)*len(EQ_STATS))
+# equation_statistics fields stored in eq_stats.bin, in order
+EQ_STATS = ["num_features", "num_operators", "num_leaves", "depth"]
+
+
+
+#####################################################  Build Index  #####################################################
+
+"""
+build_index:
+    Purpose:
+        extract every document in a corpus folder & write an offline inverted index of
+        feature -> sorted equation id postings, readable without a database process
+    Input:
+        corpus_folder (str) - folder of html documents
+        index_dir (str) - folder the index files are written to, created if it doesn't exist
+        workers (int) - number of parsing processes
+        standardize (bool) - standardize variable names, so equations differing only in them are merged
+    Output:
+        None - index files are written to index_dir
+"""
+def build_index(corpus_folder, index_dir, workers=1, standardize=False):
+    os.makedirs(index_dir, exist_ok=True)
+    eq_ids, feature_ids = {}, {}            # Key: equation / feature key, Value: id
+    equations, features = [], []            # records in id order
+    postings = []                           # postings[feature id] = array of equation ids
+    postings_tf = []                        # postings_tf[feature id] = tf of the feature in each of its postings
+    eq_features = []                        # eq_features[equation id] = feature ids of equation
+    eq_stats = array('I')                   # EQ_STATS of every equation, back to back
+    symbols = SymbolTable()                 # operator labels of the index, saved with it
+
+    files = [corpus_folder + '/' + doc for doc in os.listdir(corpus_folder)]
+    for doc_idx, (file, extracted, error, cache_stats) in enumerate(iter_extracted_documents(files, workers, standardize=standardize)):
+        if error != None:
+            print(doc_idx, file, "FAILED")
+            continue
+        doc, doc_equations = extracted
+        for eq_key, fingerprint, mathml, latex, eq_ftrs, stats in doc_equations:
+            if eq_key in eq_ids:
+                equations[eq_ids[eq_key]]["docs"].append(doc)
+                continue
+            eq_id = len(equations)
+            eq_ids[eq_key] = eq_id
+            equations.append({"id": eq_key, "fingerprint": fingerprint, "mathml": mathml, "latex": latex, "docs": [doc]})
+            eq_stats.extend(stats[name] for name in EQ_STATS)
+            ids = []
+            for ftr_key, operators, tf in eq_ftrs:
+                if ftr_key not in feature_ids:
+                    feature_ids[ftr_key] = len(features)
+                    features.append([ftr_key, list(symbols.encode(operators))])
+                    postings.append(array('I'))
+                    postings_tf.append(array('I'))
+                # equation ids are assigned in increasing order so every postings list stays sorted
+                postings[feature_ids[ftr_key]].append(eq_id)
+                postings_tf[feature_ids[ftr_key]].append(tf)
+                ids.append(feature_ids[ftr_key])
+            eq_features.append(array('I', ids))
+        print(doc_idx, doc)
+
+    # subsequence index: operator symbol id -> sorted ids of the features whose path contains it
+    op_postings = [array('I') for _ in range(len(symbols))]
+    for fid, (ftr_key, operators) in enumerate(features):
+        for operator in set(operators):
+            op_postings[operator].append(fid)
+    _write_arrays(index_dir, OP_POSTINGS_FILE, OP_POSTINGS_IDX_FILE, op_postings)
+    symbols.save(os.path.join(index_dir, SYMBOLS_FILE))
+
+    _write_arrays(index_dir, POSTINGS_FILE, POSTINGS_IDX_FILE, postings)
+    with open(os.path.join(index_dir, POSTINGS_TF_FILE), "wb") as f:
+        for a in postings_tf:
+            a.tofile(f)
+    _write_arrays(index_dir, EQ_FEATURES_FILE, EQ_FEATURES_IDX_FILE, eq_features)
+    with open(os.path.join(index_dir, EQ_STATS_FILE), "wb") as f:
+        eq_stats.tofile(f)
+    offsets = array('Q')
+    with open(os.path.join(index_dir, EQUATIONS_FILE), "wb") as f:
+        for record in equations:
+            offsets.append(f.tell())
+            f.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b"\n")
+    with open(os.path.join(index_dir, EQUATIONS_IDX_FILE), "wb") as f:
+        offsets.tofile(f)
+    with open(os.path.join(index_dir, FEATURES_FILE), "w") as f:
+        json.dump(features, f, ensure_ascii=False)
+    with open(os.path.join(index_dir, META_FILE), "w") as f:
+        total_features = sum(eq_stats[i] for i in range(0, len(eq_stats), len(EQ_STATS)))
+        json.dump({"num_equations": len(equations), "num_features": len(features),
+                   "avg_num_features": total_features / len(equations) if equations else 0, "standardized": standardize}, f)
+
+
+
+# write a list of uint32 arrays back to back into data_file, with the uint64 start offset of each (plus the end) in idx_file
+def _write_arrays(index_dir, data_file, idx_file, arrays):
+    offsets = array('Q', [0])
+    with open(os.path.join(index_dir, data_file), "wb") as f:
+        for a in arrays:
+            a.tofile(f)
+            offsets.append(offsets[-1] + len(a))
+    with open(os.path.join(index_dir, idx_file), "wb") as f:
+        offsets.tofile(f)
+
+
+
+#####################################################  Query Index  #####################################################
+
+# memory map a file read-only, the mmap is appended to maps so its owner can close it, an empty file can't be mapped
+def _mmap_file(path, maps):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    maps.append(m)
+    return m
+
+# memory map a file of native unsigned ints as a read-only sequence
+def _mmap_array(path, typecode, maps):
+    m = _mmap_file(path, maps)
+    return array(typecode) if len(m) == 0 else memoryview(m).cast(typecode)
+
+
+
+# intersection of sorted sequences, the shortest is filtered by binary searches into the others
+def intersect_postings(lists):
+    if lists == []:
+        return []
+    lists = sorted(lists, key=len)
+    result = list(lists[0])
+    for other in lists[1:]:
+        kept, lo = [], 0
+        for eq_id in result:
+            lo = bisect_left(other, eq_id, lo)
+            if lo == len(other):
+                break
+            if other[lo] == eq_id:
+                kept.append(eq_id)
+        result = kept
+        if result == []:
+            break
+    return result
+
+
+
+"""
+OfflineIndex:
+    Purpose:
+        read-only, memory mapped inverted index written by build_index, with the same query surface
+        as the Neo4j query functions in SearchEngine.py. Equations are returned as [mathml, latex]
+    Input:
+        index_dir (str) - folder written by build_index
+"""
+class OfflineIndex:
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, META_FILE), "r") as f:
+            self.meta = json.load(f)
+        with open(os.path.join(index_dir, FEATURES_FILE), "r") as f:
+            features = json.load(f)
+        self.symbols = SymbolTable.load(os.path.join(index_dir, SYMBOLS_FILE))
+        self.feature_ops = [tuple(operators) for key, operators in features]      # operator symbol ids of every feature
+        self.feature_ids = {key: fid for fid, (key, operators) in enumerate(features)}
+        self.maps = []                      # mmaps of the index files, unmapped by close
+        self.postings = _mmap_array(os.path.join(index_dir, POSTINGS_FILE), 'I', self.maps)
+        self.postings_idx = _mmap_array(os.path.join(index_dir, POSTINGS_IDX_FILE), 'Q', self.maps)
+        self.postings_tf = _mmap_array(os.path.join(index_dir, POSTINGS_TF_FILE), 'I', self.maps)
+        self.eq_features = _mmap_array(os.path.join(index_dir, EQ_FEATURES_FILE), 'I', self.maps)
+        self.eq_features_idx = _mmap_array(os.path.join(index_dir, EQ_FEATURES_IDX_FILE), 'Q', self.maps)
+        self.eq_stats = _mmap_array(os.path.join(index_dir, EQ_STATS_FILE), 'I', self.maps)
+        self.equation_offsets = _mmap_array(os.path.join(index_dir, EQUATIONS_IDX_FILE), 'Q', self.maps)
+        self.equations = _mmap_file(os.path.join(index_dir, EQUATIONS_FILE), self.maps)
+        self.op_postings = _mmap_array(os.path.join(index_dir, OP_POSTINGS_FILE), 'I', self.maps)
+        self.op_postings_idx = _mmap_array(os.path.join(index_dir, OP_POSTINGS_IDX_FILE), 'Q', self.maps)
+        self.path_matrix = None             # feature paths encoded for is_subsequence_bulk, built on first use
+
+    # unmap the index files, the views into them are released first since an mmap can't be closed while one is alive
+    def close(self):
+        for value in list(vars(self).values()):
+            if isinstance(value, memoryview):
+                value.release()
+        for m in self.maps:
+            try:
+                m.close()
+            except BufferError:
+                pass                        # a caller still holds a slice of it, it's unmapped once that is collected
+        self.maps = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # sorted equation ids containing feature id fid
+    def posting(self, fid):
+        return self.postings[self.postings_idx[fid]:self.postings_idx[fid + 1]]
+
+    # tf of feature id fid in each equation of posting(fid)
+    def posting_tf(self, fid):
+        return self.postings_tf[self.postings_idx[fid]:self.postings_idx[fid + 1]]
+
+    # inverse equation frequency of feature id fid
+    def idf(self, fid):
+        return bm25_idf(self.postings_idx[fid + 1] - self.postings_idx[fid], self.meta["num_equations"])
+
+    # sorted feature ids whose path contains operator symbol id op_id
+    def op_posting(self, op_id):
+        return self.op_postings[self.op_postings_idx[op_id]:self.op_postings_idx[op_id + 1]]
+
+    # ids of the features containing every operator in operators, found by intersecting operator postings
+    def features_containing(self, operators):
+        op_ids = self.symbols.encode_known(set(operators))
+        if op_ids == ():
+            return range(len(self.feature_ops))
+        if op_ids == None:
+            return []
+        return intersect_postings([self.op_posting(op_id) for op_id in op_ids])
+
+    # ids of the features whose path has S as a subsequence, candidates from the operator index are verified in bulk
+    def features_with_subsequence(self, S):
+        candidates = np.asarray(self.features_containing(S), dtype=np.intp)
+        if len(candidates) == 0:
+            return []
+        if self.path_matrix is None:
+            # feature paths are already symbol ids, so the table is the operator encoding
+            self.path_matrix = np.full((len(self.feature_ops), max(map(len, self.feature_ops), default=0)), -1, dtype=np.int32)
+            for fid, operators in enumerate(self.feature_ops):
+                self.path_matrix[fid, :len(operators)] = operators
+        return candidates[is_subsequence_bulk(S, self.path_matrix[candidates], self.symbols.ids)].tolist()
+
+    # operator labels of feature id fid
+    def operators(self, fid):
+        return list(self.symbols.decode(self.feature_ops[fid]))
+
+    # feature ids of equation eq_id
+    def features_of(self, eq_id):
+        return self.eq_features[self.eq_features_idx[eq_id]:self.eq_features_idx[eq_id + 1]]
+
+    # precomputed equation_statistics of equation eq_id
+    def statistics(self, eq_id):
+        start = eq_id * len(EQ_STATS)
+        return dict(zip(EQ_STATS, self.eq_stats[start:start + len(EQ_STATS)]))
+
+    # number of features of equation eq_id
+    def num_features(self, eq_id):
+        return self.eq_stats[eq_id * len(EQ_STATS)]
+
+    # whether equation eq_id has between min_features & max_features features, None for no bound
+    def _in_size_range(self, eq_id, min_features, max_features):
+        num_features = self.num_features(eq_id)
+        return (min_features == None or num_features >= min_features) and (max_features == None or num_features <= max_features)
+
+    # stored record of equation eq_id, read from the mapped file without a shared file position so threads can share the index
+    def record(self, eq_id):
+        start = self.equation_offsets[eq_id]
+        return json.loads(self.equations[start:self.equations.find(b"\n", start)])
+
+    # [mathml, latex] of equation eq_id, the same equation value returned by the Neo4j queries
+    def equation(self, eq_id):
+        record = self.record(eq_id)
+        return [record["mathml"], record["latex"]]
+
+    # distinct feature ids of the indexed features in feature_list
+    def _feature_ids(self, feature_list):
+        fids = set()
+        for feature in feature_list:
+            fid = self.feature_ids.get(feature_key(feature))
+            if fid != None:
+                fids.add(fid)
+        return fids
+
+    # Find equations containing all features in feature_list
+    def eqns_with_feats(self, feature_list):
+        keys = set(feature_key(feature) for feature in feature_list)
+        if keys == set() or any(key not in self.feature_ids for key in keys):
+            return []
+        eq_ids = intersect_postings([self.posting(self.feature_ids[key]) for key in keys])
+        return [self.equation(eq_id) for eq_id in eq_ids]
+
+    # Find equations & corresp. ftrs containing S as subfeature
+    def eqns_with_subfeat(self, S):
+        matched = {}                        # Key: equation id, Value: operators of matching features
+        for fid in self.features_with_subsequence(S):
+            for eq_id in self.posting(fid):
+                matched.setdefault(eq_id, []).append(self.operators(fid))
+        return [(self.equation(eq_id), matched[eq_id]) for eq_id in sorted(matched)]
+
+    # [mathml, latex] of every equation id in the lists of eq_ids, each record is read once & in file order
+    def _equations_batch(self, eq_ids):
+        equations = {eq_id: None for ids in eq_ids for eq_id in ids}
+        for eq_id in sorted(equations):
+            equations[eq_id] = self.equation(eq_id)
+        return equations
+
+    # eqns_with_feats of every feature list in feature_lists, results[i] is the result of feature_lists[i]
+    def eqns_with_feats_batch(self, feature_lists):
+        eq_ids = []
+        for feature_list in feature_lists:
+            keys = set(feature_key(feature) for feature in feature_list)
+            if keys == set() or any(key not in self.feature_ids for key in keys):
+                eq_ids.append([])
+            else:
+                eq_ids.append(intersect_postings([self.posting(self.feature_ids[key]) for key in keys]))
+        equations = self._equations_batch(eq_ids)
+        return [[equations[eq_id] for eq_id in ids] for ids in eq_ids]
+
+    # eqns_with_subfeat of every subsequence in subsequences, results[i] is the result of subsequences[i]
+    def eqns_with_subfeat_batch(self, subsequences):
+        matches = []
+        for S in subsequences:
+            matched = {}                    # Key: equation id, Value: operators of matching features
+            for fid in self.features_with_subsequence(S):
+                for eq_id in self.posting(fid):
+                    matched.setdefault(eq_id, []).append(self.operators(fid))
+            matches.append(matched)
+        equations = self._equations_batch(matches)
+        return [[(equations[eq_id], matched[eq_id]) for eq_id in sorted(matched)] for matched in matches]
+
+    # eqns_with_partial_feature of SearchEngine, equations containing some of the most selective subsequences of feature
+    def eqns_with_partial_feature(self, feature, min_len=1, max_len=None, limit=PARTIAL_MATCH_LIMIT):
+        subsequences = [list(S) for S in iter_feature_subsets(feature, min_len, max_len, limit)]
+        return [(S, matches) for S, matches in zip(subsequences, self.eqns_with_subfeat_batch(subsequences)) if matches != []]
+
+    # Find equations matching with some features in feature_list
+    def match_some_ftrs(self, feature_list):
+        counts = {}
+        for fid in self._feature_ids(feature_list):
+            for eq_id in self.posting(fid):
+                counts[eq_id] = counts.get(eq_id, 0) + 1
+        # like the Cypher query, total_features counts the matched features of the equation
+        ranked = sorted(counts.items(), key=lambda item: -item[1])
+        return [(self.equation(eq_id), num_matched, num_matched) for eq_id, num_matched in ranked]
+
+    # Find equations matching with some subfeatures in subfeatures_list
+    def match_some_subfeats_ordered(self, subfeatures_list):
+        # like the Cypher query, a feature matches a subfeature when it contains all of its operators
+        fids = set()
+        for subsequence in subfeatures_list:
+            fids.update(self.features_containing(subsequence))
+        counts = {}
+        for fid in fids:
+            for eq_id in self.posting(fid):
+                counts[eq_id] = counts.get(eq_id, 0) + 1
+        ranked = sorted(((eq_id, cnt, self.num_features(eq_id)) for eq_id, cnt in counts.items()), key=lambda item: (-item[1], -item[2]))
+        return [(self.equation(eq_id), cnt, total) for eq_id, cnt, total in ranked]
+
+    """
+    ranked_results_page:
+        Purpose:
+            rank equations by the ranked_results score (0.5 * exact feature matches + 0.5 * subfeature matches)
+            in a single pass over the postings, only the records of the returned page are read
+        Input:
+            feature_list (list[list[str]]) - query features
+            k (int) - page size
+            cursor (tuple) - next_cursor of the previous page, None for the first page
+            min_features, max_features (int) - only rank equations whose feature count is in this range, None for no bound
+        Output:
+            (results, next_cursor) - results is a list of (equation, score) in descending score order,
+                                     next_cursor is None when there are no more results
+    """
+    def ranked_results_page(self, feature_list, k=10, cursor=None, min_features=None, max_features=None):
+        if k <= 0:
+            return [], None
+        n = len(feature_list)
+        scores = {}
+
+        # exact matches, like match_some_ftrs the denominator is max(matched features, query features)
+        exact = {}
+        for fid in self._feature_ids(feature_list):
+            for eq_id in self.posting(fid):
+                exact[eq_id] = exact.get(eq_id, 0) + 1
+        for eq_id, num_matched in exact.items():
+            scores[eq_id] = 0.5 * num_matched / max(num_matched, n)
+
+        # subfeature matches, the denominator is max(equation features, query features)
+        fids = set()
+        for subsequence in feature_list:
+            if len(subsequence) > 0:
+                fids.update(self.features_containing(subsequence))
+        sub = {}
+        for fid in fids:
+            for eq_id in self.posting(fid):
+                sub[eq_id] = sub.get(eq_id, 0) + 1
+        for eq_id, num_matched in sub.items():
+            scores[eq_id] = scores.get(eq_id, 0) + 0.5 * num_matched / max(self.num_features(eq_id), n)
+
+        # rank by (score desc, equation id), resuming after the cursor
+        candidates = ((-score, eq_id) for eq_id, score in scores.items())
+        if min_features != None or max_features != None:
+            candidates = (item for item in candidates if self._in_size_range(item[1], min_features, max_features))
+        if cursor != None:
+            candidates = (item for item in candidates if item > cursor)
+        page = heapq.nsmallest(k, candidates)
+        results = [(self.equation(eq_id), -neg_score) for neg_score, eq_id in page]
+        next_cursor = page[-1] if len(page) == k else None
+        return results, next_cursor
+
+    """
+    bm25_results_page:
+        Purpose:
+            rank equations by BM25 over the query feature paths with MaxScore early termination. Query features are
+            ordered by their score upper bound, once the top k is full the features whose bounds together can't beat
+            its lowest score become non-essential: their postings are only probed for equations found in the others
+        Input:
+            feature_list (list[list[str]]) - query features
+            k (int) - page size
+            cursor (tuple) - next_cursor of the previous page, None for the first page
+            k1, b (float) - BM25 parameters, b must be below 1 for the upper bounds to hold
+        Output:
+            (results, next_cursor) - as in ranked_results_page
+    """
+    def bm25_results_page(self, feature_list, k=10, cursor=None, k1=BM25_K1, b=BM25_B):
+        if k <= 0:
+            return [], None
+        avg_num_features = self.meta["avg_num_features"]
+        # [upper bound, idf, postings, tfs, position] per query feature, by increasing upper bound
+        terms = []
+        for fid in self._feature_ids(feature_list):
+            idf = self.idf(fid)
+            terms.append([idf * (k1 + 1), idf, self.posting(fid), self.posting_tf(fid), 0])
+        terms.sort(key=lambda term: term[0])
+        bounds = list(itertools.accumulate(term[0] for term in terms))     # bounds[i] = upper bound of terms[:i+1]
+
+        # score contribution of the term at its current position, which must hold equation eq_id
+        def weight(term, eq_id):
+            return bm25_weight(term[1], term[3][term[4]], self.num_features(eq_id), avg_num_features, k1, b)
+
+        heap = []                           # the best k equations so far as (score, -equation id), worst first
+        essential = 0                       # equations can only beat the heap if they occur in terms[essential:]
+        while True:
+            # next equation, in id order, of the essential postings
+            eq_id = min((term[2][term[4]] for term in terms[essential:] if term[4] < len(term[2])), default=None)
+            if eq_id == None:
+                break
+            contributions = []
+            for term in terms[essential:]:
+                if term[4] < len(term[2]) and term[2][term[4]] == eq_id:
+                    contributions.append(weight(term, eq_id))
+                    term[4] += 1
+            # probe the non-essential postings, largest bound first, until the rest can't lift eq_id into the heap
+            score = sum(contributions)
+            for i in range(essential - 1, -1, -1):
+                if score + bounds[i] <= heap[0][0]:
+                    break
+                term = terms[i]
+                term[4] = bisect_left(term[2], eq_id, term[4])
+                if term[4] < len(term[2]) and term[2][term[4]] == eq_id:
+                    contributions.append(weight(term, eq_id))
+                    score += contributions[-1]
+            # fsum is exact, so an equation's score doesn't depend on the order its contributions were found in
+            score = math.fsum(contributions)
+            if cursor != None and (-score, eq_id) <= cursor:
+                continue
+            if len(heap) < k:
+                heapq.heappush(heap, (score, -eq_id))
+            elif (score, -eq_id) > heap[0]:
+                heapq.heapreplace(heap, (score, -eq_id))
+            else:
+                continue
+            if len(heap) == k:
+                while essential < len(terms) and bounds[essential] <= heap[0][0]:
+                    essential += 1
+
+        page = sorted(heap, reverse=True)
+        results = [(self.equation(-neg_id), score) for score, neg_id in page]
+        next_cursor = (-page[-1][0], -page[-1][1]) if len(page) == k else None
+        return results, next_cursor
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("index_dir")
+    parser.add_argument("--build", metavar="CORPUS_FOLDER", help="build the index from a folder of html documents")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--standardize", action="store_true", help="build with standardized variable names")
+    args = parser.parse_args()
+
+    if args.build != None:
+        build_index(args.build, args.index_dir, args.workers, args.standardize)
+    with OfflineIndex(args.index_dir) as index:
+        print(len(index.feature_ops), "features", len(index.equation_offsets), "equations")
+        print(len(index.match_some_ftrs([["times", "plus", "times"]])), "equations match ['times', 'plus', 'times']")
@@ -0,0 +1,163 @@
+from collections import OrderedDict
+from functools import wraps
+import threading
+import time
+
+
+
+#####################################################  Query Cache  #####################################################
+
+"""
+QueryCache:
+    Purpose:
+        LRU cache of query results bounded by number of entries & age, entries older than ttl seconds are
+        treated as misses. hits & misses are counted so the hit rate can be monitored.
+        every invalidation starts a new generation, & a result is only stored if no invalidation happened since
+        its query started, so a query racing an ingestion can't cache a stale result. ingestion in another
+        process is seen through generation_source / async_generation_source, a function returning the store's
+        ingest generation, polled at most every sync_interval seconds. without a source only ttl bounds the
+        staleness of results cached before another process ingested
+    Input:
+        max_size (int) - max number of cached results, the least recently used result is evicted first
+        ttl (float) - seconds a result stays valid, None for no expiry
+        sync_interval (float) - min seconds between two reads of the store's ingest generation
+"""
+class QueryCache:
+    def __init__(self, max_size=1024, ttl=300, sync_interval=5):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sync_interval = sync_interval
+        self.entries = OrderedDict()        # Key: (query name, canonical arguments), Value: (time stored, result)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0                 # number of invalidations so far
+        self.store_generation = None        # last ingest generation read from the store
+        self.last_sync = None               # time of the last read of the store's generation
+        self.generation_source = None       # function returning the store's ingest generation, None if unknown
+        self.async_generation_source = None # coroutine function returning the same, used by cached_async_query
+
+    # cached result of key, or (False, None) if it isn't cached or has expired
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry != None and (self.ttl == None or time.monotonic() - entry[0] < self.ttl):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            if entry != None:
+                del self.entries[key]
+            self.misses += 1
+            return False, None
+
+    # store result, unless the cache was invalidated after generation, the value of begin() when the query started
+    def put(self, key, result, generation=None):
+        with self.lock:
+            if generation != None and generation != self.generation:
+                return
+            self.entries[key] = (time.monotonic(), result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    # drop every cached result, called whenever new equations are written to the database
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    # generation to pass to put for a query starting now, the store's generation is read first if a sync is due
+    def begin(self):
+        if self.generation_source != None and self._claim_sync():
+            self.observe(self.generation_source())
+        return self.generation
+
+    async def begin_async(self):
+        if self.async_generation_source != None and self._claim_sync():
+            self.observe(await self.async_generation_source())
+        return self.generation
+
+    # record the store's ingest generation, the cache is invalidated if it changed since the last read
+    def observe(self, store_generation):
+        if store_generation == None:
+            return
+        with self.lock:
+            changed = store_generation != self.store_generation
+            self.store_generation = store_generation
+        if changed:
+            self.invalidate()
+
+    # True for the one caller that should read the store's generation now
+    def _claim_sync(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.last_sync != None and now - self.last_sync < self.sync_interval:
+                return False
+            self.last_sync = now
+            return True
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups > 0 else 0.0, "generation": self.generation}
+
+
+
+#####################################################  Canonical Keys  #####################################################
+
+# features of a query where neither order nor duplicates change the result
+def canonical_feature_set(feature_list):
+    return tuple(sorted(set(tuple(feature) for feature in feature_list)))
+
+# subsequences of a query that are matched by containment, so only the set of operators in each one matters
+def canonical_operator_sets(subfeatures_list):
+    return tuple(sorted(set(tuple(sorted(set(subsequence))) for subsequence in subfeatures_list)))
+
+# ordered operator sequence, order matters but lists & tuples are the same query
+def canonical_sequence(S):
+    return tuple(S)
+
+
+
+"""
+cached_query:
+    Purpose:
+        decorator caching the results of a single argument query function in cache under its canonical argument
+    Input:
+        cache (QueryCache) - cache shared by the query functions
+        canonicalize (function) - maps the query argument to a hashable key, equal for queries with equal results
+    Output:
+        decorator - the wrapped function returns a shallow copy of the cached result so callers can't modify it,
+                    a result is only cached if the cache wasn't invalidated while its query ran
+"""
+def cached_query(cache, canonicalize):
+    def decorator(query_fn):
+        @wraps(query_fn)
+        def wrapper(arg):
+            key = (query_fn.__name__, canonicalize(arg))
+            generation = cache.begin()
+            found, result = cache.get(key)
+            if not found:
+                result = query_fn(arg)
+                cache.put(key, result, generation)
+            return list(result)
+        return wrapper
+    return decorator
+
+
+
+# cached_query for async query functions, the coroutine is only awaited on a miss
+def cached_async_query(cache, canonicalize):
+    def decorator(query_fn):
+        @wraps(query_fn)
+        async def wrapper(arg):
+            key = (query_fn.__name__, canonicalize(arg))
+            generation = await cache.begin_async()
+            found, result = cache.get(key)
+            if not found:
+                result = await query_fn(arg)
+                cache.put(key, result, generation)
+            return list(result)
+        return wrapper
+    return decorator
@@ -2,156 +2,807 @@ from neo4j import GraphDatabase
 from MathMLLibrary.standardize_tree import *
 from MathMLLibrary.pull_features import *
 from MathMLLibrary.html_to_tree import *
+from MathMLLibrary.tree_keys import *
+from CorpusPipeline import *
+from QueryCache import *
+from contextlib import contextmanager
+import threading
+import argparse
 import time
 import os
 
 
 
+#####################################################  Engine  #####################################################
+
+"""
+GraphEngine:
+    Purpose:
+        owns a configured Neo4j driver & its connection pool. The functions in this module run on the current engine,
+        set by entering the engine as a context manager or with use_engine. Sessions are reused: while a session
+        block is open on a thread, every query of that thread runs on it instead of opening a new session
+    Input:
+        uri, user, password (str) - database location & credentials
+        max_connection_pool_size (int) - max number of pooled connections
+        connection_acquisition_timeout (float) - seconds to wait for a free pooled connection before failing
+        fetch_size (int) - number of records fetched per round trip when reading results
+        database (str) - database name, None for the server default
+"""
+class GraphEngine:
+    def __init__(self, uri, user, password, max_connection_pool_size=100, connection_acquisition_timeout=60, fetch_size=1000, database=None):
+        self.driver = GraphDatabase.driver(uri, auth=(user, password), max_connection_pool_size=max_connection_pool_size,
+                                           connection_acquisition_timeout=connection_acquisition_timeout)
+        self.fetch_size = fetch_size
+        self.database = database
+        self.local = threading.local()      # session currently open on each thread
+
+    # session of the enclosing session block on this thread, or a new one closed when the block exits
+    @contextmanager
+    def session(self):
+        session = getattr(self.local, "session", None)
+        if session != None:
+            yield session
+            return
+        session = self.driver.session(database=self.database, fetch_size=self.fetch_size)
+        self.local.session = session
+        try:
+            yield session
+        finally:
+            self.local.session = None
+            session.close()
+
+    # a session of its own for results consumed lazily, so queries run meanwhile on this thread don't force them to be buffered
+    def dedicated_session(self, fetch_size=None):
+        return self.driver.session(database=self.database, fetch_size=fetch_size if fetch_size != None else self.fetch_size)
+
+    def verify_connectivity(self):
+        self.driver.verify_connectivity()
+
+    # close every pooled connection, the engine can't be used afterwards
+    def close(self):
+        if current_engine_or_none() is self:
+            use_engine(None)
+        self.driver.close()
+
+    def __enter__(self):
+        self.previous = current_engine_or_none()
+        use_engine(self)
+        return self
+
+    def __exit__(self, *exc):
+        self.driver.close()
+        use_engine(self.previous)
+
+
+_engine = None
+
+# make engine the one used by the functions in this module, None to unset it
+def use_engine(engine):
+    global _engine
+    _engine = engine
+
+def current_engine_or_none():
+    return _engine
+
+def current_engine():
+    if _engine == None:
+        raise RuntimeError("no GraphEngine in use, enter one with 'with GraphEngine(...)' or call use_engine")
+    return _engine
+
+
+
 #####################################################  Create Nodes, Relationships, Populate DB  ##################################################### 
 
 def execute_write_query(query, params=None):
-    with driver.session() as session:
+    with current_engine().session() as session:
         session.execute_write(lambda tx: tx.run(query, params))
 
 # Key: DB creation operation, Value: function to execute operation
 cmap = {
-    "connect":  lambda uri, username, password: GraphDatabase.driver(uri, auth=(username, password)),
+    "connect":  lambda uri, username, password: GraphEngine(uri, username, password),
     "doc": lambda doc_name: execute_write_query("MERGE (doc:Doc {id: $doc_name})", {"doc_name": doc_name}),
-    "eq": lambda equation_id: execute_write_query("MERGE (eq:Equation {id: $equation_id})", {"equation_id": equation_id}),
-    "ftr": lambda feature_id: execute_write_query("MERGE (feat:Feature {id: $feature_id})", {"feature_id": feature_id}),
+    "eq": lambda equation_id, fingerprint, mathml, latex, stats: execute_write_query(bmap["eq"], {"rows": [{"equation_id": equation_id, "fingerprint": fingerprint, "mathml": mathml, "latex": latex, "stats": stats}]}),
+    "ftr": lambda feature_id, operators: execute_write_query("MERGE (feat:Feature {id: $feature_id}) ON CREATE SET feat.ops = $operators", {"feature_id": feature_id, "operators": operators}),
     "EQN_IN": lambda equation_id, doc_id: execute_write_query("MATCH (eq:Equation {id: $equation_id}), (doc:Doc {id: $doc_id}) MERGE (eq)-[:EQN_IN]->(doc)", {"equation_id": equation_id, "doc_id": doc_id}),
-    "HAS_FTR": lambda equation_id, feature_id: execute_write_query("MATCH (eq:Equation {id: $equation_id}), (f:Feature {id: $feature_id}) MERGE (eq)-[:HAS_FTR]->(f)", {"equation_id": equation_id, "feature_id": feature_id})
+    "HAS_FTR": lambda equation_id, feature_id, tf: execute_write_query("MATCH (eq:Equation {id: $equation_id}), (f:Feature {id: $feature_id}) MERGE (eq)-[r:HAS_FTR]->(f) ON CREATE SET r.tf = $tf, f.df = coalesce(f.df, 0) + 1", {"equation_id": equation_id, "feature_id": feature_id, "tf": tf}),
+    "HAS_OP": lambda feature_id, operators: execute_write_query("MATCH (f:Feature {id: $feature_id}) UNWIND $operators AS name MERGE (o:Operator {name: name}) MERGE (f)-[:HAS_OP]->(o)", {"feature_id": feature_id, "operators": operators}),
+    # ingest generation, incremented after every write so query caches in other processes know to drop their results
+    "generation": lambda: execute_write_query("MERGE (c:Corpus {id: 'corpus'}) SET c.generation = coalesce(c.generation, 0) + 1")
 }
 
 # Populate the database with documents
-def populate_db(corpus_folder):
+# standardize renames variable leaves so equations differing only in variable names are merged
+def populate_db(corpus_folder, standardize=False):
+    setup_schema()
     doc_idx = 0
-    for doc in os.listdir(corpus_folder):
-        file = corpus_folder + '/' + doc                                                              
-        math_ml_strings, trees = toMathMLStrings(file), getTreesFromFile(file)    
-        cmap["doc"](doc)                                            # create doc             
-        for idx, eq in enumerate(math_ml_strings):
-            cmap["eq"](eq)
-            cmap["EQN_IN"](eq, doc)                              
-            features = get_features(trees[idx])                     # create eq, eq in doc
-            for feature in features:                                        
-                cmap["ftr"](feature)
-                cmap["HAS_FTR"](eq, feature)                        # create feature, eq has feature
+    with current_engine().session():                                # every write below reuses one session
+        seen = set()                                                # keys of the equations written so far
+        for doc in os.listdir(corpus_folder):
+            file = corpus_folder + '/' + doc                                                              
+            cmap["doc"](doc)                                            # create doc             
+            for mathml, latex, tree in iterEquations(file, standardize=standardize):
+                if len(tree) == 0:                                      # toOpTree found no operator tree
+                    continue
+                eq_key = equation_key(tree)
+                if eq_key in seen:
+                    cmap["EQN_IN"](eq_key, doc)                         # duplicate, only link it to doc
+                    continue
+                seen.add(eq_key)
+                features = get_features(tree)
+                cmap["eq"](eq_key, equation_fingerprint(tree), mathml, latex, equation_statistics(tree, features))
+                cmap["EQN_IN"](eq_key, doc)                             # create eq, eq in doc
+                tfs = {}
+                for feature in features:
+                    tfs[feature] = tfs.get(feature, 0) + 1
+                for feature, tf in tfs.items():
+                    ftr_key = feature_key(feature)
+                    cmap["ftr"](ftr_key, feature)
+                    cmap["HAS_OP"](ftr_key, list(set(feature)))         # index feature by its operators
+                    cmap["HAS_FTR"](eq_key, ftr_key, tf)                # create feature, eq has feature
+            mark_ingested()                                             # cached results may miss the new equations
+            print(doc_idx, doc)
+            doc_idx += 1
+
+
+
+# Key: bulk DB creation operation, Value: parameterized query merging every row in $rows
+# stale edges of re-indexed docs are removed first, nodes must be written before the relationships that MATCH them
+# the Corpus node & Feature.df hold the BM25 corpus statistics, they are updated as equations & HAS_FTR edges come & go
+bmap = {
+    "unlink": (
+        "UNWIND $rows AS row "
+        "MATCH (eq:Equation)-[r:EQN_IN]->(doc:Doc {id: row.doc_id}) "
+        "DELETE r "
+        "WITH DISTINCT eq "
+        "WHERE NOT (eq)-[:EQN_IN]->() "
+        "CALL { WITH eq MATCH (eq)-[:HAS_FTR]->(f:Feature) SET f.df = f.df - 1 } "
+        "WITH collect(eq) AS orphans "
+        "MERGE (c:Corpus {id: 'corpus'}) "
+        "SET c.num_equations = coalesce(c.num_equations, 0) - size(orphans), "
+        "    c.total_features = coalesce(c.total_features, 0) - reduce(n = 0, eq IN orphans | n + coalesce(eq.num_features, 0)) "
+        "FOREACH (eq IN orphans | DETACH DELETE eq)"    # equations no longer in any doc lose their HAS_FTR edges
+    ),
+    "doc": "UNWIND $rows AS row MERGE (doc:Doc {id: row.doc_id})",
+    "eq": (
+        "UNWIND $rows AS row "
+        "OPTIONAL MATCH (old:Equation {id: row.equation_id}) "
+        "WITH row WHERE old IS NULL "
+        "CREATE (eq:Equation {id: row.equation_id}) SET eq.fingerprint = row.fingerprint, eq.mathml = row.mathml, eq.latex = row.latex, eq += row.stats "
+        "WITH count(eq) AS created, sum(row.stats.num_features) AS num_features "
+        "MERGE (c:Corpus {id: 'corpus'}) "
+        "SET c.num_equations = coalesce(c.num_equations, 0) + created, c.total_features = coalesce(c.total_features, 0) + num_features"
+    ),
+    "ftr": "UNWIND $rows AS row MERGE (feat:Feature {id: row.feature_id}) ON CREATE SET feat.ops = row.operators",
+    "HAS_OP": "UNWIND $rows AS row MATCH (f:Feature {id: row.feature_id}) UNWIND row.operators AS name MERGE (o:Operator {name: name}) MERGE (f)-[:HAS_OP]->(o)",
+    "EQN_IN": "UNWIND $rows AS row MATCH (eq:Equation {id: row.equation_id}), (doc:Doc {id: row.doc_id}) MERGE (eq)-[:EQN_IN]->(doc)",
+    "HAS_FTR": "UNWIND $rows AS row MATCH (eq:Equation {id: row.equation_id}), (f:Feature {id: row.feature_id}) MERGE (eq)-[r:HAS_FTR]->(f) ON CREATE SET r.tf = row.tf, f.df = coalesce(f.df, 0) + 1"
+}
+
+
+
+"""
+IngestBatch:
+    Purpose:
+        accumulates the docs, equations, features & edges of one or more documents as de-duplicated
+        parameter rows for the UNWIND queries in bmap
+"""
+class IngestBatch:
+    def __init__(self):
+        self.rows = {key: [] for key in bmap}
+        self.seen = {key: set() for key in bmap}
+        self.num_docs = 0
+        self.files = []
+
+    # add a row for operation key unless an identical row is already in the batch
+    def add(self, key, dedup_key, row):
+        if dedup_key in self.seen[key]:
+            return
+        self.seen[key].add(dedup_key)
+        self.rows[key].append(row)
+
+    # add a document along with all of its equations & features, equations are extracted by extract_document
+    # a re-indexed document has its previous EQN_IN edges removed before the new ones are written
+    # equations in written (keys already written by earlier batches) only get their EQN_IN edge
+    def add_document(self, doc, equations, reindex=False, written=frozenset()):
+        if reindex:
+            self.add("unlink", doc, {"doc_id": doc})
+        self.add("doc", doc, {"doc_id": doc})
+        for eq_key, fingerprint, mathml, latex, features, stats in equations:
+            self.add("EQN_IN", (eq_key, doc), {"equation_id": eq_key, "doc_id": doc})
+            if eq_key in written or eq_key in self.seen["eq"]:
+                continue
+            self.add("eq", eq_key, {"equation_id": eq_key, "fingerprint": fingerprint, "mathml": mathml, "latex": latex, "stats": stats})
+            for ftr_key, feature, tf in features:
+                self.add("ftr", ftr_key, {"feature_id": ftr_key, "operators": feature})
+                self.add("HAS_OP", ftr_key, {"feature_id": ftr_key, "operators": list(set(feature))})
+                self.add("HAS_FTR", (eq_key, ftr_key), {"equation_id": eq_key, "feature_id": ftr_key, "tf": tf})
+        self.num_docs += 1
+
+
+
+"""
+flush_batch:
+    Purpose:
+        write an IngestBatch to the database with one UNWIND transaction per operation & chunk of rows
+    Input:
+        batch (IngestBatch) - rows collected for the batch
+        batch_size (int) - max number of rows sent in a single transaction
+    Output:
+        None - the batch is written to the database
+"""
+def flush_batch(batch, batch_size):
+    with current_engine().session():
+        for key, query in bmap.items():
+            rows = batch.rows[key]
+            for start in range(0, len(rows), batch_size):
+                execute_write_query(query, {"rows": rows[start:start + batch_size]})
+
+
+
+"""
+populate_db_bulk:
+    Purpose:
+        bulk version of populate_db, documents are parsed by a pool of worker processes, collected in batches
+        & written by this process with a few UNWIND transactions instead of one transaction per node & relationship.
+        an ingestion manifest records each document's state, so unchanged documents are skipped, changed documents
+        are re-indexed & a re-run resumes after a crash or failed documents
+    Input:
+        corpus_folder (str) - folder of html documents
+        docs_per_batch (int) - number of documents collected before writing to the database
+        batch_size (int) - max number of rows sent in a single transaction
+        workers (int) - number of parsing processes, documents are parsed in this process when workers <= 1
+        manifest_path (str) - ingestion manifest file, defaults to <corpus_folder>.manifest.sqlite
+        standardize (bool) - standardize variable names, so equations differing only in them are merged.
+                             a database must be populated in one mode, the manifest doesn't record it
+    Output:
+        None - the database is populated with the corpus
+"""
+def populate_db_bulk(corpus_folder, docs_per_batch=50, batch_size=10000, workers=1, manifest_path=None, standardize=False):
+    setup_schema()
+    if manifest_path == None:
+        manifest_path = corpus_folder.rstrip('/') + '.manifest.sqlite'
+    manifest = IngestManifest(manifest_path)
+    files = [corpus_folder + '/' + doc for doc in os.listdir(corpus_folder)]
+    todo = manifest.plan(files)
+    print(len(todo), "of", len(files), "documents to ingest")
+
+    written = set()                     # keys of the equations written by this run
+    cache_stats = {}                    # Key: extracting process id, Value: its latest FEATURE_CACHE stats
+
+    # mark the batch pending while it is written so a crash leaves it to be re-indexed on the next run
+    def _write(batch):
+        manifest.mark(batch.files, PENDING)
+        flush_batch(batch, batch_size)
+        written.update(batch.seen["eq"])
+        mark_ingested()
+        manifest.mark(batch.files, DONE)
+        stats = combine_cache_stats(cache_stats)
+        print("feature cache:", stats["hits"], "hits", stats["misses"], "misses", "hit rate %.3f," % stats["hit_rate"],
+              stats["num_features"], "features cached,", stats["skipped"], "equations too small to memoize")
+
+    batch = IngestBatch()
+    for doc_idx, (file, extracted, error, (pid, stats)) in enumerate(iter_extracted_documents(list(todo), workers, standardize=standardize)):
+        cache_stats[pid] = stats
+        if error != None:
+            print(doc_idx, file, "FAILED")
+            manifest.mark([file], FAILED, error)
+            continue
+        doc, equations = extracted
+        batch.add_document(doc, equations, reindex=todo[file], written=written)
+        batch.files.append(file)
         print(doc_idx, doc)
-        doc_idx += 1
+        if batch.num_docs >= docs_per_batch:
+            _write(batch)
+            batch = IngestBatch()
+    if batch.num_docs > 0:
+        _write(batch)
+    manifest.close()
+
+
+
+#####################################################  Database Schema  ##################################################### 
+
+# Key: schema object name, Value: idempotent statement creating it
+# each uniqueness constraint is backed by a range index on the constrained property, which MERGE & MATCH use for id lookups
+schema = {
+    "doc_id": "CREATE CONSTRAINT doc_id IF NOT EXISTS FOR (doc:Doc) REQUIRE doc.id IS UNIQUE",
+    "equation_id": "CREATE CONSTRAINT equation_id IF NOT EXISTS FOR (eq:Equation) REQUIRE eq.id IS UNIQUE",
+    "feature_id": "CREATE CONSTRAINT feature_id IF NOT EXISTS FOR (feat:Feature) REQUIRE feat.id IS UNIQUE",
+    "operator_name": "CREATE CONSTRAINT operator_name IF NOT EXISTS FOR (o:Operator) REQUIRE o.name IS UNIQUE",
+    "corpus_id": "CREATE CONSTRAINT corpus_id IF NOT EXISTS FOR (c:Corpus) REQUIRE c.id IS UNIQUE",
+    # equation statistics written at ingestion, for size filters
+    "equation_num_features": "CREATE RANGE INDEX equation_num_features IF NOT EXISTS FOR (eq:Equation) ON (eq.num_features)",
+    "equation_num_operators": "CREATE RANGE INDEX equation_num_operators IF NOT EXISTS FOR (eq:Equation) ON (eq.num_operators)",
+    "equation_num_leaves": "CREATE RANGE INDEX equation_num_leaves IF NOT EXISTS FOR (eq:Equation) ON (eq.num_leaves)",
+    "equation_depth": "CREATE RANGE INDEX equation_depth IF NOT EXISTS FOR (eq:Equation) ON (eq.depth)",
+    # equation_fingerprint, shared by equations equal up to reordering commutative operands
+    "equation_fingerprint": "CREATE RANGE INDEX equation_fingerprint IF NOT EXISTS FOR (eq:Equation) ON (eq.fingerprint)",
+}
+
+# placeholder parameters so every query in bmap & qmap can be planned with EXPLAIN
+EXPLAIN_PARAMS = {"rows": [], "feature_list": [], "subsequence": [], "subsequences": [], "operators": [], "num_operators": 0, "feature_ids": [],
+                  "num_query_features": 1, "cursor": None, "k": 10, "min_features": None, "max_features": None,
+                  "k1": BM25_K1, "b": BM25_B, "limit": 10, "offset": 0, "queries": []}
+
+
+
+"""
+setup_schema:
+    Purpose:
+        create the constraints & indexes in schema if they don't already exist, safe to run before every ingestion
+    Input:
+        timeout (int) - seconds to wait for newly created indexes to come online
+    Output:
+        None - schema is created & online
+"""
+def setup_schema(timeout=300):
+    with current_engine().session() as session:
+        for statement in schema.values():
+            session.run(statement).consume()
+        session.run("CALL db.awaitIndexes($timeout)", {"timeout": timeout}).consume()
+
+
+
+"""
+index_usage:
+    Purpose:
+        collect the index backed operators used by the plan of a query
+    Input:
+        plan (dict) - query plan from a result summary
+    Output:
+        list of (operator, details) for every index seek or scan in the plan
+"""
+def index_usage(plan):
+    used = []
+    if plan == None:
+        return used
+    operator = plan.get("operatorType", "")
+    if "Index" in operator:
+        details = plan.get("args", {}).get("Details", "")
+        used.append((operator.split("@")[0], details))
+    for child in plan.get("children", []):
+        used.extend(index_usage(child))
+    return used
+
+
+
+"""
+report_schema_usage:
+    Purpose:
+        EXPLAIN every ingestion & search query & report which indexes their plans use
+    Input:
+        None
+    Output:
+        dict - Key: query name, Value: list of (operator, details) for indexes used by the query plan
+"""
+def report_schema_usage():
+    queries = {"bulk " + key: query for key, query in bmap.items()}
+    queries.update(qmap)
+    usage = {}
+    with current_engine().session() as session:
+        for name, query in queries.items():
+            summary = session.run("EXPLAIN " + query, EXPLAIN_PARAMS).consume()
+            usage[name] = index_usage(summary.plan)
+            print(name, usage[name] if usage[name] != [] else "NO INDEX USED")
+    return usage
 
 
 
 #####################################################  Query Database   ##################################################### 
 
 
+# Key: query operation, Value: cypher query run by the query function of the same name
+qmap = {
+    "corpus_generation": "OPTIONAL MATCH (c:Corpus {id: 'corpus'}) RETURN coalesce(c.generation, 0) AS generation",
+    "eqns_with_feats": (
+        "MATCH (eq:Equation)-[r:HAS_FTR]->(f:Feature) "
+        "WHERE f.id IN $feature_list "
+        "WITH eq, collect(f.id) AS matched_features "
+        "WHERE ALL (x IN $feature_list WHERE x IN matched_features) "
+        "RETURN [eq.mathml, eq.latex] AS equation"
+    ),
+    # subsequence index: features containing the rarest operator of $operators, all operators must exist
+    "subfeat_candidates": '''
+            MATCH (o:Operator) WHERE o.name IN $operators
+            WITH o, COUNT { (o)<-[:HAS_OP]-() } AS num_features
+            ORDER BY num_features
+            WITH collect(o) AS ops
+            WHERE size(ops) = $num_operators
+            WITH ops[0] AS rarest
+            MATCH (rarest)<-[:HAS_OP]-(f:Feature)
+            RETURN f.id AS feature_id, f.ops AS operators
+        ''',
+    "all_features": "MATCH (f:Feature) RETURN f.id AS feature_id, f.ops AS operators",
+    "eqns_with_feature_ids": '''
+            MATCH (e:Equation)-[:HAS_FTR]->(f:Feature)
+            WHERE f.id IN $feature_ids
+            WITH e, COLLECT(f.ops) AS all_features
+            RETURN [e.mathml, e.latex] AS equation_id, all_features
+        ''',
+    "match_some_ftrs": (
+        "MATCH (eq:Equation)-[r:HAS_FTR]->(f:Feature) "
+        "WHERE f.id IN $feature_list "
+        "WITH eq, collect(f.id) AS matched_features, count(f) AS total_features "
+        "ORDER BY size(matched_features) DESC "  # order by number of matched features
+        "RETURN [eq.mathml, eq.latex] AS equation, size(matched_features) AS num_matched, total_features"
+    ),
+    "match_some_subfeats_ordered": '''
+            UNWIND $subsequences as subsequence
+            MATCH (e:Equation)-[:HAS_FTR]->(f:Feature)
+            WHERE ALL(item IN subsequence WHERE item IN f.ops)
+            WITH e, count(DISTINCT f.id) AS matched_subfeature_count
+            WITH [e.mathml, e.latex] AS equation_id, matched_subfeature_count, coalesce(e.num_features, COUNT { (e)-[:HAS_FTR]->() }) AS total_features
+            RETURN DISTINCT equation_id, matched_subfeature_count, total_features
+            ORDER BY matched_subfeature_count DESC, total_features DESC
+        ''',
+    # ranked_results score of every candidate in one round trip, only the top $k after $cursor are returned
+    # each operator set in $subsequences is matched in its own subquery, so its operators are never grouped with another's
+    "ranked_results_page": '''
+            CALL {
+                MATCH (eq:Equation)-[:HAS_FTR]->(f:Feature)
+                WHERE f.id IN $feature_list
+                  AND ($min_features IS NULL OR eq.num_features >= $min_features)
+                  AND ($max_features IS NULL OR eq.num_features <= $max_features)
+                WITH eq, count(f) AS num_matched
+                RETURN eq, 0.5 * num_matched / CASE WHEN num_matched > $num_query_features THEN num_matched ELSE $num_query_features END AS part
+              UNION ALL
+                UNWIND $subsequences AS subsequence
+                CALL {
+                    WITH subsequence
+                    MATCH (o:Operator) WHERE o.name IN subsequence
+                    WITH subsequence, o
+                    ORDER BY COUNT { (o)<-[:HAS_OP]-() }
+                    WITH subsequence, collect(o) AS ops
+                    WHERE size(ops) = size(subsequence)
+                    WITH subsequence, ops[0] AS rarest
+                    MATCH (rarest)<-[:HAS_OP]-(f:Feature)
+                    WHERE ALL(item IN subsequence WHERE item IN f.ops)
+                    RETURN f
+                }
+                MATCH (eq:Equation)-[:HAS_FTR]->(f)
+                WHERE ($min_features IS NULL OR eq.num_features >= $min_features)
+                  AND ($max_features IS NULL OR eq.num_features <= $max_features)
+                WITH eq, count(DISTINCT f) AS num_matched
+                WITH eq, num_matched, coalesce(eq.num_features, COUNT { (eq)-[:HAS_FTR]->() }) AS total_features
+                RETURN eq, 0.5 * num_matched / CASE WHEN total_features > $num_query_features THEN total_features ELSE $num_query_features END AS part
+            }
+            WITH eq, sum(part) AS score
+            WHERE $cursor IS NULL OR score < $cursor.score OR (score = $cursor.score AND eq.id > $cursor.id)
+            WITH eq, score
+            ORDER BY score DESC, eq.id
+            LIMIT $k
+            RETURN eq.id AS equation_key, [eq.mathml, eq.latex] AS equation, score
+        ''',
+    # BM25 over the query features, same weights as bm25_weight, only the top $k after $cursor are returned. a graph
+    # loaded before the statistics were maintained has no Corpus node or num_features, they are counted instead
+    "bm25_results_page": '''
+            OPTIONAL MATCH (c:Corpus {id: 'corpus'})
+            CALL {
+                WITH c
+                WITH c WHERE c.num_equations IS NULL OR c.total_features IS NULL
+                MATCH (eq:Equation)
+                RETURN count(eq) AS counted_equations, sum(coalesce(eq.num_features, COUNT { (eq)-[:HAS_FTR]->() })) AS counted_features
+            }
+            WITH coalesce(c.num_equations, counted_equations) AS num_equations, coalesce(c.total_features, counted_features) AS total_features
+            WITH num_equations, toFloat(total_features) / CASE WHEN num_equations > 0 THEN num_equations ELSE 1 END AS avg_num_features
+            MATCH (f:Feature) WHERE f.id IN $feature_list
+            WITH num_equations, avg_num_features, f, coalesce(f.df, COUNT { (f)<-[:HAS_FTR]-() }) AS df
+            WITH avg_num_features, f, log(1 + (num_equations - df + 0.5) / (df + 0.5)) AS idf
+            MATCH (eq:Equation)-[r:HAS_FTR]->(f)
+            WITH eq, coalesce(r.tf, 1) AS tf, idf, avg_num_features
+            WITH eq, coalesce(eq.num_features, COUNT { (eq)-[:HAS_FTR]->() }) AS num_features, tf, idf, avg_num_features
+            WITH eq, sum(idf * tf * ($k1 + 1) / (tf + $k1 * (1 - $b + $b * num_features / avg_num_features))) AS score
+            WHERE $cursor IS NULL OR score < $cursor.score OR (score = $cursor.score AND eq.id > $cursor.id)
+            WITH eq, score
+            ORDER BY score DESC, eq.id
+            LIMIT $k
+            RETURN eq.id AS equation_key, [eq.mathml, eq.latex] AS equation, score
+        ''',
+    # batch queries, $queries is a list of per query parameters & each result row carries the index of its query
+    "eqns_with_feats_batch": '''
+            UNWIND range(0, size($queries) - 1) AS qid
+            WITH qid, $queries[qid] AS feature_list
+            CALL {
+                WITH feature_list
+                MATCH (eq:Equation)-[:HAS_FTR]->(f:Feature)
+                WHERE f.id IN feature_list
+                WITH feature_list, eq, collect(f.id) AS matched_features
+                WHERE ALL (x IN feature_list WHERE x IN matched_features)
+                RETURN collect([eq.mathml, eq.latex]) AS equations
+            }
+            RETURN qid, equations
+        ''',
+    "subfeat_candidates_batch": '''
+            UNWIND range(0, size($queries) - 1) AS qid
+            WITH qid, $queries[qid] AS operators
+            CALL {
+                WITH operators
+                MATCH (o:Operator) WHERE o.name IN operators
+                WITH operators, o, COUNT { (o)<-[:HAS_OP]-() } AS num_features
+                ORDER BY num_features
+                WITH operators, collect(o) AS ops
+                WHERE size(ops) = size(operators)
+                WITH ops[0] AS rarest
+                MATCH (rarest)<-[:HAS_OP]-(f:Feature)
+                RETURN f.id AS feature_id, f.ops AS feature_ops
+            }
+            RETURN qid, feature_id, feature_ops AS operators
+        ''',
+    "eqns_with_feature_ids_batch": '''
+            UNWIND range(0, size($queries) - 1) AS qid
+            WITH qid, $queries[qid] AS feature_ids
+            CALL {
+                WITH feature_ids
+                MATCH (e:Equation)-[:HAS_FTR]->(f:Feature)
+                WHERE f.id IN feature_ids
+                WITH e, COLLECT(f.ops) AS all_features
+                RETURN collect([[e.mathml, e.latex], all_features]) AS matches
+            }
+            RETURN qid, matches
+        '''
+}
+
+
+# results of the query functions below, invalidated by populate_db & populate_db_bulk in this process & through
+# the Corpus node's ingest generation when another process ingests
+query_cache = QueryCache()
+
+# ingest generation of the database, None if no engine is in use
+def corpus_generation():
+    engine = current_engine_or_none()
+    if engine == None:
+        return None
+    with engine.session() as session:
+        return session.run(qmap["corpus_generation"]).single()["generation"]
+
+query_cache.generation_source = corpus_generation
+
+# make newly written data visible, the ingest generation is bumped for other processes & this process's cache is cleared
+def mark_ingested():
+    cmap["generation"]()
+    query_cache.invalidate()
+
+
 # Find equations containing all features in feature_list
+@cached_query(query_cache, canonical_feature_set)
 def eqns_with_feats(feature_list):
-    with driver.session() as session:
-        query = (
-            f"MATCH (eq:Equation)-[r:HAS_FTR]->(f:Feature) "
-            f"WHERE f.id IN $feature_list "
-            f"WITH eq, collect(f.id) AS matched_features "
-            f"WHERE ALL (x IN $feature_list WHERE x IN matched_features) "
-            f"RETURN eq.id"
-        )
-        parameters = {'feature_list': feature_list}
-        result = session.run(query, parameters)
+    with current_engine().session() as session:
+        parameters = {'feature_list': [feature_key(f) for f in feature_list]}
+        result = session.run(qmap["eqns_with_feats"], parameters)
         records = list(result)  # convert the result to a list immediately
-    equations = [record["eq.id"] for record in records]
+    equations = [record["equation"] for record in records]
     return equations
 
 
+# query & parameters fetching the candidate features of S, those linked to every operator of S or all of them for an empty S
+def _subfeat_candidates(S):
+    operators = list(set(S))
+    if operators == []:
+        return qmap["all_features"], {}
+    return qmap["subfeat_candidates"], {"operators": operators, "num_operators": len(operators)}
+
+# ids of the candidate feature records whose operators contain S as a subsequence
+def _subfeat_matches(S, candidates):
+    return [record['feature_id'] for record in candidates if is_subsequence(S, record['operators'])]
+
+# ids of the features containing S as a subsequence, shared by eqns_with_subfeat & iter_eqns_with_subfeat
+def _subfeat_feature_ids(session, S):
+    query, parameters = _subfeat_candidates(S)
+    return _subfeat_matches(S, session.run(query, parameters))
+
+
 # Find equations & corresp. ftrs containing S as subfeature
+# candidates come from the operator index & are verified with is_subsequence, instead of scanning every HAS_FTR edge
+@cached_query(query_cache, canonical_sequence)
 def eqns_with_subfeat(S):
-    with driver.session() as session:
-        result = session.run('''
-            MATCH (e:Equation)-[:HAS_FTR]->(f:Feature)
-            WHERE ALL(item IN $subsequence WHERE item IN f.id)
-            WITH e.id AS equation_id, f.id AS features
-            WITH equation_id, features, $subsequence AS subsequence
-            WITH equation_id, features, 
-                    REDUCE(
-                        acc = {lastIdx: -1, indices: []},
-                        item IN subsequence | 
-                        {
-                        lastIdx: COALESCE(
-                                    [idx IN range(acc.lastIdx+1, size(features)-1) WHERE features[idx] = item][0],
-                                    -1
-                                    ),
-                        indices: acc.indices + COALESCE(
-                                    [idx IN range(acc.lastIdx+1, size(features)-1) WHERE features[idx] = item][0],
-                                    -1
-                                    )
-                        }
-                    ).indices AS operator_indices
-            WHERE ALL(idx IN range(1, size(operator_indices) - 1) WHERE operator_indices[idx] > operator_indices[idx - 1])
-            WITH equation_id, COLLECT(features) AS all_features, COLLECT(operator_indices) AS all_operator_indices
-            RETURN equation_id, all_features
-        ''', {"subsequence": S})
+    with current_engine().session() as session:
+        feature_ids = _subfeat_feature_ids(session, S)
+        if feature_ids == []:
+            return []
+        result = session.run(qmap["eqns_with_feature_ids"], {"feature_ids": feature_ids})
         return [(record['equation_id'], record['all_features']) for record in result]
 
 
+
+"""
+build_operator_index:
+    Purpose:
+        link every Feature that has no HAS_OP edges to the Operator nodes of its path, indexes graphs loaded
+        before the operator index existed
+    Input:
+        None
+    Output:
+        None - HAS_OP edges are created in batches of 10000 features
+"""
+def build_operator_index():
+    setup_schema()
+    with current_engine().session() as session:
+        session.run('''
+            MATCH (f:Feature) WHERE NOT (f)-[:HAS_OP]->()
+            CALL {
+                WITH f
+                UNWIND f.ops AS name
+                MERGE (o:Operator {name: name})
+                MERGE (f)-[:HAS_OP]->(o)
+            } IN TRANSACTIONS OF 10000 ROWS
+        ''').consume()
+
+
+
+"""
+build_feature_statistics:
+    Purpose:
+        compute the BM25 statistics (Feature.df, HAS_FTR.tf, Equation.num_features & the Corpus node) of graphs
+        loaded before they were maintained at ingestion, HAS_FTR edges without a tf are counted once
+    Input:
+        None
+    Output:
+        None - statistics are written in batches of 10000 features & equations
+"""
+def build_feature_statistics():
+    setup_schema()
+    with current_engine().session() as session:
+        session.run('''
+            MATCH (f:Feature)
+            CALL {
+                WITH f
+                MATCH (f)<-[r:HAS_FTR]-()
+                SET r.tf = coalesce(r.tf, 1)
+                WITH f, count(r) AS df
+                SET f.df = df
+            } IN TRANSACTIONS OF 10000 ROWS
+        ''').consume()
+        session.run('''
+            MATCH (eq:Equation) WHERE eq.num_features IS NULL
+            CALL {
+                WITH eq
+                SET eq.num_features = COUNT { (eq)-[:HAS_FTR]->() }
+            } IN TRANSACTIONS OF 10000 ROWS
+        ''').consume()
+        session.run('''
+            MATCH (eq:Equation)
+            WITH count(eq) AS num_equations, sum(eq.num_features) AS total_features
+            MERGE (c:Corpus {id: 'corpus'})
+            SET c.num_equations = num_equations, c.total_features = total_features
+        ''').consume()
+
+
 # Find equations matching with some features in feature_list
+@cached_query(query_cache, canonical_feature_set)
 def match_some_ftrs(feature_list):
-    with driver.session() as session:
-        query = (
-            f"MATCH (eq:Equation)-[r:HAS_FTR]->(f:Feature) "
-            f"WHERE f.id IN $feature_list "
-            f"WITH eq, collect(f.id) AS matched_features, count(f) AS total_features "
-            f"ORDER BY size(matched_features) DESC "  # order by number of matched features
-            f"RETURN eq.id, size(matched_features) AS num_matched, total_features"
-        )
-        parameters = {'feature_list': feature_list}
-        result = session.run(query, parameters)
+    with current_engine().session() as session:
+        parameters = {'feature_list': [feature_key(f) for f in feature_list]}
+        result = session.run(qmap["match_some_ftrs"], parameters)
         records = list(result)  # convert the result to a list immediately
         
-    equations = [(record["eq.id"], record["num_matched"], record["total_features"]) for record in records if record["num_matched"] > 0]  # only include equations that have at least one feature matched
+    equations = [(record["equation"], record["num_matched"], record["total_features"]) for record in records if record["num_matched"] > 0]  # only include equations that have at least one feature matched
     return equations
 
 
 # Find equations matching with some subfeatures in subfeatures_list
+@cached_query(query_cache, canonical_operator_sets)
 def match_some_subfeats_ordered(subfeatures_list):
-    with driver.session() as session:
-        result = session.run('''
-            UNWIND $subsequences as subsequence
-            MATCH (e:Equation)-[:HAS_FTR]->(f:Feature)
-            WHERE ALL(item IN subsequence WHERE item IN f.id)
-            WITH e.id AS equation_id, count(DISTINCT f.id) AS matched_subfeature_count
-            MATCH (e:Equation {id: equation_id})-[:HAS_FTR]->(all_f:Feature)
-            WITH equation_id, matched_subfeature_count, count(all_f) AS total_features
-            RETURN DISTINCT equation_id, matched_subfeature_count, total_features
-            ORDER BY matched_subfeature_count DESC, total_features DESC
-        ''', {"subsequences": subfeatures_list})
+    with current_engine().session() as session:
+        result = session.run(qmap["match_some_subfeats_ordered"], {"subsequences": subfeatures_list})
 
         return [(record['equation_id'], record['matched_subfeature_count'], record['total_features']) for record in result]
 
 
 
-def ranked_results(feature_list):
-    exact_matches = match_some_ftrs(feature_list)
-    subftr_matches = match_some_subfeats_ordered(feature_list)
+# distinct operator sets of the non-empty query features, the subfeature part of the ranked_results score counts the
+# distinct features containing any of them, so features sharing an operator set are matched once
+def ranked_page_subsequences(feature_list):
+    return [list(operators) for operators in sorted(set(tuple(sorted(set(f))) for f in feature_list if len(f) > 0))]
+
+
+
+"""
+ranked_results_page:
+    Purpose:
+        rank equations by the ranked_results score (0.5 * exact feature matches + 0.5 * subfeature matches)
+        in a single query & return one page of the best matches
+    Input:
+        feature_list (list[list[str]]) - query features
+        k (int) - page size
+        cursor (dict) - next_cursor of the previous page, None for the first page
+        min_features, max_features (int) - only rank equations whose feature count is in this range, None for no bound
+    Output:
+        (results, next_cursor) - results is a list of (equation, score) in descending score order,
+                                 next_cursor is None when there are no more results
+"""
+def ranked_results_page(feature_list, k=10, cursor=None, min_features=None, max_features=None):
+    if k <= 0:
+        return [], None
+    parameters = {
+        "feature_list": [feature_key(f) for f in feature_list],
+        "subsequences": ranked_page_subsequences(feature_list),
+        "num_query_features": len(feature_list),
+        "cursor": cursor,
+        "k": k,
+        "min_features": min_features,
+        "max_features": max_features
+    }
+    with current_engine().session() as session:
+        records = list(session.run(qmap["ranked_results_page"], parameters))
+    results = [(record["equation"], record["score"]) for record in records]
+    next_cursor = None
+    if len(records) == k:
+        next_cursor = {"score": records[-1]["score"], "id": records[-1]["equation_key"]}
+    return results, next_cursor
+
+
+
+"""
+bm25_results_page:
+    Purpose:
+        rank equations by BM25 over the query feature paths, paths found in few equations weigh more than
+        ubiquitous ones & scores are normalized by equation feature count, returns one page of the best matches
+    Input:
+        feature_list (list[list[str]]) - query features
+        k (int) - page size
+        cursor (dict) - next_cursor of the previous page, None for the first page
+        k1, b (float) - BM25 parameters
+    Output:
+        (results, next_cursor) - as in ranked_results_page
+"""
+def bm25_results_page(feature_list, k=10, cursor=None, k1=BM25_K1, b=BM25_B):
+    if k <= 0:
+        return [], None
+    parameters = {
+        "feature_list": list(set(feature_key(f) for f in feature_list)),
+        "cursor": cursor,
+        "k": k,
+        "k1": k1,
+        "b": b
+    }
+    with current_engine().session() as session:
+        records = list(session.run(qmap["bm25_results_page"], parameters))
+    results = [(record["equation"], record["score"]) for record in records]
+    next_cursor = None
+    if len(records) == k:
+        next_cursor = {"score": records[-1]["score"], "id": records[-1]["equation_key"]}
+    return results, next_cursor
+
+
+
+"""
+score_matches:
+    Purpose:
+        combine the results of match_some_ftrs & match_some_subfeats_ordered into the ranked_results score
+    Input:
+        num_query_features (int) - number of query features
+        exact_matches (list) - (equation, num_matched, num_ftrs) from match_some_ftrs
+        subftr_matches (list) - (equation, cnt, num_ftrs) from match_some_subfeats_ordered
+    Output:
+        dict - Key: equation as a tuple, Value: 0.5 * exact match ratio + 0.5 * subfeature match ratio
+"""
+def score_matches(num_query_features, exact_matches, subftr_matches):
     eq_to_rank = {}
 
     # Exact Matches
     for eq_id, num_matched, num_ftrs in exact_matches:
         key = tuple(eq_id)
         val = int(num_matched)
-        denom = max(int(num_ftrs), len(feature_list))
+        denom = max(int(num_ftrs), num_query_features)
         if key not in eq_to_rank:
             eq_to_rank[key] = 0
         eq_to_rank[key] += 0.5 * (val/denom)
- 
 
     # Subfeature Matches
-    seen_keys = set()
-    for eq_id, cnt, num_ftrs in subftr_matches: 
+    for eq_id, cnt, num_ftrs in subftr_matches:
         key = tuple(eq_id)
         val = int(cnt)
-        denom = max(int(num_ftrs), len(feature_list))
+        denom = max(int(num_ftrs), num_query_features)
         if key not in eq_to_rank:
             eq_to_rank[key] = 0
         eq_to_rank[key] += 0.5*(val/denom)
+    return eq_to_rank
+
+
+def ranked_results(feature_list):
+    exact_matches = match_some_ftrs(feature_list)
+    subftr_matches = match_some_subfeats_ordered(feature_list)
+    eq_to_rank = score_matches(len(feature_list), exact_matches, subftr_matches)
 
     # Group results by rank
     rank_to_eq = {}
@@ -219,16 +870,197 @@ def ranked_results(feature_list):
 
 
 
+
+
+
+#####################################################  Batch Queries  #####################################################
+
+# split queries into cached results & the indexes of the queries that still have to be run,
+# along with the cache generation to store their results under
+def _cached_batch(query_name, queries, canonicalize):
+    generation = query_cache.begin()
+    results, missing = [None] * len(queries), []
+    for qid, query in enumerate(queries):
+        found, result = query_cache.get((query_name, canonicalize(query)))
+        if found:
+            results[qid] = list(result)
+        else:
+            missing.append(qid)
+    return results, missing, generation
+
+
+
+"""
+eqns_with_feats_batch:
+    Purpose:
+        eqns_with_feats for many feature lists in a single round trip, queries already in the cache aren't sent
+    Input:
+        feature_lists (list[list[list[str]]]) - one feature list per query
+    Output:
+        list - results[i] is the eqns_with_feats result of feature_lists[i]
+"""
+def eqns_with_feats_batch(feature_lists):
+    results, missing, generation = _cached_batch("eqns_with_feats", feature_lists, canonical_feature_set)
+    if missing == []:
+        return results
+    queries = [[feature_key(f) for f in feature_lists[qid]] for qid in missing]
+    for qid in missing:
+        results[qid] = []
+    with current_engine().session() as session:
+        for record in session.run(qmap["eqns_with_feats_batch"], {"queries": queries}):
+            qid = missing[record["qid"]]
+            results[qid] = record["equations"]
+            query_cache.put(("eqns_with_feats", canonical_feature_set(feature_lists[qid])), results[qid], generation)
+    return results
+
+
+
+"""
+eqns_with_subfeat_batch:
+    Purpose:
+        eqns_with_subfeat for many subsequences in two round trips, one fetching the candidate features of
+        every subsequence & one fetching the equations of every verified candidate set
+    Input:
+        subsequences (list[list[str]]) - one operator subsequence per query
+    Output:
+        list - results[i] is the eqns_with_subfeat result of subsequences[i]
+"""
+def eqns_with_subfeat_batch(subsequences):
+    results, missing, generation = _cached_batch("eqns_with_subfeat", subsequences, canonical_sequence)
+    if missing == []:
+        return results
+    feature_ids = {qid: [] for qid in missing}      # Key: query index, Value: ids of features containing its subsequence
+    with current_engine().session() as session:
+        # an empty subsequence matches every feature
+        if any(len(subsequences[qid]) == 0 for qid in missing):
+            all_features = list(session.run(qmap["all_features"]))
+            for qid in missing:
+                if len(subsequences[qid]) == 0:
+                    feature_ids[qid] = [record["feature_id"] for record in all_features]
+        candidates = [qid for qid in missing if len(subsequences[qid]) > 0]
+        if candidates != []:
+            for record in session.run(qmap["subfeat_candidates_batch"], {"queries": [list(set(subsequences[qid])) for qid in candidates]}):
+                qid = candidates[record["qid"]]
+                if is_subsequence(subsequences[qid], record["operators"]):
+                    feature_ids[qid].append(record["feature_id"])
+
+        for qid in missing:
+            results[qid] = []
+        queried = [qid for qid in missing if feature_ids[qid] != []]
+        if queried != []:
+            for record in session.run(qmap["eqns_with_feature_ids_batch"], {"queries": [feature_ids[qid] for qid in queried]}):
+                results[queried[record["qid"]]] = [(equation, all_features) for equation, all_features in record["matches"]]
+    for qid in missing:
+        query_cache.put(("eqns_with_subfeat", canonical_sequence(subsequences[qid])), results[qid], generation)
+    return results
+
+
+
+"""
+eqns_with_partial_feature:
+    Purpose:
+        query expansion for partial matches, equations containing some subsequence of a query feature. the
+        subsequences are generated lazily by iter_feature_subsets, most selective first, so a long feature only
+        builds the limit subsequences that are queried, & they are all matched with one eqns_with_subfeat_batch
+    Input:
+        feature (list[str]) - operator path of a query feature
+        min_len, max_len (int) - shortest & longest subsequence tried, max_len None for the length of feature
+        limit (int) - max number of subsequences tried
+    Output:
+        list of (subsequence, eqns_with_subfeat result) for the subsequences some equation contains, most selective first
+"""
+def eqns_with_partial_feature(feature, min_len=1, max_len=None, limit=PARTIAL_MATCH_LIMIT):
+    subsequences = [list(S) for S in iter_feature_subsets(feature, min_len, max_len, limit)]
+    return [(S, matches) for S, matches in zip(subsequences, eqns_with_subfeat_batch(subsequences)) if matches != []]
+
+
+
+#####################################################  Streaming Queries  #####################################################
+
+# append the order & SKIP / LIMIT of a page to a query ending in RETURN, an unbounded stream is left unordered
+# so its first records arrive before every match is found
+def _page_query(query, order_by, limit, offset):
+    if limit == None and offset == 0:
+        return query
+    query += " ORDER BY " + order_by + " SKIP $offset"
+    if limit != None:
+        query += " LIMIT $limit"
+    return query
+
+
+
+# records of a query read lazily in batches of fetch_size, the session is closed when the generator is exhausted or closed
+def _stream(query, parameters, fetch_size):
+    with current_engine().dedicated_session(fetch_size) as session:
+        for record in session.run(query, parameters):
+            yield record
+
+
+
+"""
+iter_eqns_with_feats:
+    Purpose:
+        streaming eqns_with_feats, equations are yielded as they are fetched instead of being collected in a list
+    Input:
+        feature_list (list[list[str]]) - features every equation must contain
+        fetch_size (int) - records fetched per round trip, None for the engine's fetch size
+        limit (int) - max number of equations, None for all
+        offset (int) - number of equations skipped, pages are ordered by equation key when limit or offset is given
+    Output:
+        generator of [mathml, latex]
+"""
+def iter_eqns_with_feats(feature_list, fetch_size=None, limit=None, offset=0):
+    parameters = {"feature_list": [feature_key(f) for f in feature_list], "limit": limit, "offset": offset}
+    query = _page_query(qmap["eqns_with_feats"], "eq.id", limit, offset)
+    for record in _stream(query, parameters, fetch_size):
+        yield record["equation"]
+
+
+
+"""
+iter_match_some_ftrs:
+    Purpose:
+        streaming match_some_ftrs
+    Input:
+        feature_list (list[list[str]]) - query features
+        fetch_size, limit, offset - as in iter_eqns_with_feats, pages are ordered by matched features then equation key
+    Output:
+        generator of (equation, num_matched, total_features) in descending num_matched order
+"""
+def iter_match_some_ftrs(feature_list, fetch_size=None, limit=None, offset=0):
+    parameters = {"feature_list": [feature_key(f) for f in feature_list], "limit": limit, "offset": offset}
+    query = _page_query(qmap["match_some_ftrs"], "num_matched DESC, eq.id", limit, offset)
+    for record in _stream(query, parameters, fetch_size):
+        if record["num_matched"] > 0:
+            yield (record["equation"], record["num_matched"], record["total_features"])
+
+
+
+"""
+iter_eqns_with_subfeat:
+    Purpose:
+        streaming eqns_with_subfeat, only the ids of the matching features are held in memory
+    Input:
+        S (list[str]) - operator subsequence
+        fetch_size, limit, offset - as in iter_eqns_with_feats
+    Output:
+        generator of (equation, operators of its matching features)
+"""
+def iter_eqns_with_subfeat(S, fetch_size=None, limit=None, offset=0):
+    with current_engine().session() as session:
+        feature_ids = _subfeat_feature_ids(session, S)
+    if feature_ids == []:
+        return
+    query = _page_query(qmap["eqns_with_feature_ids"], "e.id", limit, offset)
+    for record in _stream(query, {"feature_ids": feature_ids, "limit": limit, "offset": offset}, fetch_size):
+        yield (record['equation_id'], record['all_features'])
 
 
 
 ##################################################### Search Functionality ##################################################### 
 
-def process_user_query(file_path):
-    formatted = toMathMLStrings(file_path)[0]
-    math_ml_string, latex_title = formatted[0], formatted[1]
-    root = toOpTree(math_ml_string)
-    tree = graphTree(root)
+def process_user_query(file_path, standardize=False):
+    math_ml_string, latex_title, tree = next(iterEquations(file_path, standardize=standardize))
     return tree, latex_title
 
 
@@ -250,6 +1082,13 @@ def f_eqns_with_subftr(subsequence):
         G = graphTree(toOpTree(math_str))
         plotTreeWithFeatures(G, latex_str, features)
 
+def f_eqns_with_partial_ftr(feature, max_len=None):
+    for subsequence, matches in eqns_with_partial_feature(feature, max_len=max_len):
+        for eq, features in matches:
+            math_str, latex_str = eq[0], eq[1]
+            G = graphTree(toOpTree(math_str))
+            plotTreeWithFeatures(G, latex_str, features)
+
 def f_eqns_with_feats(features):
     matches = eqns_with_feats(features)
     for match in matches:
@@ -273,6 +1112,9 @@ test_map = {
     "test_eqns_with_subftr_3" : lambda : f_eqns_with_subftr(["superscript", "times", "divide", "times", "superscript"]),
     "test_eqns_with_subftr_4" : lambda : f_eqns_with_subftr(['vector', 'times', 'abs', 'superscript', 'eq', 'times', 'superscript', 'divide', 'times', 'superscript']),
         
+    # test equations containing part of a feature
+    "test_eqns_with_partial_ftr" : lambda : f_eqns_with_partial_ftr(['vector', 'times', 'abs', 'superscript', 'eq', 'times', 'superscript', 'divide', 'times', 'superscript'], max_len=4),
+
     # test f_eqns_with_feats
     "test_eqns_with_feats_simple" : lambda : f_eqns_with_feats([["divide", "times", "superscript"]]),
     "test_eqns_with_feats_complex" :  lambda : f_eqns_with_feats([["times", "plus", "times", "superscript", "∇"], ["times", "plus", "times", "superscript"], ["times", "plus", "times"]]),
@@ -289,12 +1131,29 @@ test_map = {
 
 }
 if __name__ == "__main__":
-    global driver
-    driver = cmap["connect"]("bolt://localhost:7687", "neo4j", "password")
-    # test_map["test_eqns_with_subftr_1"]()
-    # test_map["test_eqns_with_most_ftrs_simple"]()
-    # test_map["test_eqns_with_subftr_2"]()
-    test_map["test_ranking_fn"]()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--uri", default="bolt://localhost:7687")
+    parser.add_argument("--user", default="neo4j")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--ingest", metavar="CORPUS_FOLDER", help="bulk load a folder of html documents")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of parsing processes used by --ingest")
+    parser.add_argument("--docs-per-batch", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--manifest", help="ingestion manifest file, defaults to <CORPUS_FOLDER>.manifest.sqlite")
+    parser.add_argument("--pool-size", type=int, default=100, help="max number of pooled database connections")
+    parser.add_argument("--acquisition-timeout", type=float, default=60, help="seconds to wait for a pooled connection")
+    parser.add_argument("--fetch-size", type=int, default=1000, help="records fetched per round trip")
+    parser.add_argument("--standardize", action="store_true", help="ingest with standardized variable names")
+    args = parser.parse_args()
+
+    with GraphEngine(args.uri, args.user, args.password, args.pool_size, args.acquisition_timeout, args.fetch_size):
+        if args.ingest != None:
+            populate_db_bulk(args.ingest, args.docs_per_batch, args.batch_size, args.workers, args.manifest, args.standardize)
+        else:
+            # test_map["test_eqns_with_subftr_1"]()
+            # test_map["test_eqns_with_most_ftrs_simple"]()
+            # test_map["test_eqns_with_subftr_2"]()
+            test_map["test_ranking_fn"]()
 
 
 
@@ -0,0 +1,178 @@
+from MathMLLibrary.html_to_tree import *
+from MathMLLibrary.pull_features import *
+from optree_regression import HERE, DEFAULT_FILES, FLAG_COMBOS
+import itertools
+import random
+import sys
+import os
+
+# seed of the random trees when none is given on the command line
+DEFAULT_SEED = 0
+# number of random trees checked
+NUM_RANDOM_TREES = 300
+# number of random subsequence patterns & of random paths they are matched against, besides the trees' features
+NUM_RANDOM_PATTERNS = 300
+NUM_RANDOM_PATHS = 2000
+# labels of the random trees, few enough that repeated operators & leaves are common
+RANDOM_OPERATORS = ["plus", "minus", "times", "divide", "eq", "superscript", "subscript", "int"]
+RANDOM_LEAVES = ["x", "y", "z", "1", "2", "𝑛_𝑖"]
+
+
+
+"""
+randomOpTree:
+    Purpose:
+        build a random operator tree, operators get 1 to 3 children & may repeat along a path
+    Input:
+        rng (random.Random) - source of randomness
+        depth (int) - max number of operators on a root to leaf path
+    Output:
+        Node - root of the tree
+"""
+def randomOpTree(rng, depth):
+    if depth == 0 or rng.random() < 0.25:
+        return Node(rng.choice(RANDOM_LEAVES))
+    return Node(rng.choice(RANDOM_OPERATORS), [randomOpTree(rng, depth - 1) for _ in range(rng.randint(1, 3))])
+
+
+
+"""
+collectTrees:
+    Purpose:
+        operator trees of every block equation of the given files with every toOpTree flag combination,
+        followed by seeded random trees
+    Input:
+        files (list[str]) - html files, relative to this script's folder
+        seed (int) - seed of the random trees
+    Output:
+        list of (name, Node) - equations toOpTree fails on are left out
+"""
+def collectTrees(files, seed):
+    trees = []
+    for filename in files:
+        mathml_strings = toMathMLStrings(os.path.join(HERE, filename))
+        for idx, (mathml_string, latex_string) in enumerate(mathml_strings):
+            for flags in FLAG_COMBOS:
+                name = filename + ":" + str(idx) + ":" + ",".join(str(flag) for flag in flags)
+                try:
+                    trees.append((name, toOpTree(mathml_string, *flags)))
+                except Exception:
+                    pass
+    rng = random.Random(seed)
+    for idx in range(NUM_RANDOM_TREES):
+        trees.append(("random:" + str(seed) + ":" + str(idx), randomOpTree(rng, rng.randint(1, 6))))
+    return trees
+
+
+
+# extractFeaturesFromRootPaths & extractFeaturesFromCompactTree give the same features, in the same order, as extractFeatures
+def checkRootPathFeatures(trees):
+    mismatches = []
+    for name, root in trees:
+        expected = extractFeatures(graphTree(root))
+        if extractFeaturesFromRootPaths(graphTree(root)) != expected or extractFeaturesFromCompactTree(compactTree(root)) != expected:
+            mismatches.append(name)
+    return len(trees), mismatches
+
+
+
+# the original recursive is_subsequence, the reference for the iterative & vectorized versions
+def recursiveIsSubsequence(S, F):
+    N = len(S)
+    M = len(F)
+    def _is_subsequence(i, j):
+        if i == N:
+            return True
+        if j == M:
+            return False
+        if S[i] == F[j]:
+            return _is_subsequence(i+1, j+1)
+        return _is_subsequence(i, j+1)
+    return _is_subsequence(0, 0)
+
+# is_subsequence & is_subsequence_bulk agree with the recursive is_subsequence on random patterns, matched against
+# the features of the trees & random paths, patterns include empty ones & operators no path contains
+def checkSubsequenceBulk(trees, seed):
+    rng = random.Random(seed)
+    paths = sorted(set(feature for name, root in trees for feature in get_features(graphTree(root))))
+    paths += [tuple(rng.choice(RANDOM_OPERATORS) for _ in range(rng.randint(0, 8))) for _ in range(NUM_RANDOM_PATHS)]
+    matrix, codes = encode_paths(paths)
+    mismatches = []
+    for idx in range(NUM_RANDOM_PATTERNS):
+        S = [rng.choice(RANDOM_OPERATORS + ["unknown"]) for _ in range(rng.randint(0, 4))]
+        expected = [recursiveIsSubsequence(S, F) for F in paths]
+        if [is_subsequence(S, F) for F in paths] != expected or is_subsequence_bulk(S, matrix, codes).tolist() != expected:
+            mismatches.append("pattern:" + str(seed) + ":" + str(idx) + ":" + ",".join(S))
+    return NUM_RANDOM_PATTERNS, mismatches
+
+
+
+# extractFeatureCodesMemoized gives the same features, in the same order, as get_feature_codes, both with a cache
+# shared by every tree & with one small enough to evict constantly, memoizing equations of any size
+def checkMemoizedFeatures(trees):
+    caches = [FeatureCache(min_leaves=0), FeatureCache(max_features=64, max_leaves=4, min_leaves=0)]
+    mismatches = []
+    for name, root in trees:
+        tree = compactTree(root)
+        expected = get_feature_codes(tree)
+        if any(extractFeatureCodesMemoized(tree, cache) != expected for cache in caches):
+            mismatches.append(name)
+    return len(trees), mismatches
+
+
+
+# iter_feature_subsets gives every distinct subsequence of the trees' features once, longest first & in the order of
+# their leftmost occurrence, & its length bounds & limit cut that order short
+def checkFeatureSubsets(trees):
+    features = sorted(set(feature for name, root in trees for feature in get_features(graphTree(root)) if len(feature) <= 8))
+    mismatches = []
+    for idx, feature in enumerate(features):
+        expected, seen = [], set()
+        for length in range(len(feature), -1, -1):
+            for positions in itertools.combinations(range(len(feature)), length):
+                subset = tuple(feature[i] for i in positions)
+                if subset not in seen:
+                    seen.add(subset)
+                    expected.append(subset)
+        non_empty = expected[:-1]
+        bounded = [subset for subset in non_empty if len(subset) <= 2]
+        if (list(iter_feature_subsets(feature, min_len=0)) != expected or list(iter_feature_subsets(feature)) != non_empty
+                or list(iter_feature_subsets(feature, max_len=2)) != bounded or list(iter_feature_subsets(feature, limit=3)) != non_empty[:3]):
+            mismatches.append("feature:" + str(idx) + ":" + ",".join(feature))
+    return len(features), mismatches
+
+
+
+# every check, each returns (number of cases, names of the failing cases)
+CHECKS = [
+    ("root path features", lambda trees, seed: checkRootPathFeatures(trees)),
+    ("subsequence matching", checkSubsequenceBulk),
+    ("memoized features", lambda trees, seed: checkMemoizedFeatures(trees)),
+    ("feature subsets", lambda trees, seed: checkFeatureSubsets(trees)),
+]
+
+
+
+"""
+Usage:
+    python feature_regression.py [--seed N] [files...]   check the optimized feature extraction & matching against
+                                                         the original implementations on the files & random trees
+"""
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    seed = DEFAULT_SEED
+    if "--seed" in args:
+        idx = args.index("--seed")
+        seed = int(args[idx + 1])
+        del args[idx:idx + 2]
+    files = args or DEFAULT_FILES
+    trees = collectTrees(files, seed)
+
+    failed = False
+    for check_name, check in CHECKS:
+        num_cases, mismatches = check(trees, seed)
+        for name in mismatches:
+            print("MISMATCH", check_name, name)
+        print(check_name + ":", num_cases - len(mismatches), "/", num_cases, "cases unchanged")
+        failed = failed or mismatches != []
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,81 @@
+from MathMLLibrary.html_to_tree import *
+from itertools import product
+import json
+import sys
+import os
+
+# folder of this script, corpus files & the golden file are looked up relative to it
+HERE = os.path.dirname(os.path.abspath(__file__))
+# corpus files checked when no files are given on the command line
+DEFAULT_FILES = ["corpus1.txt", "corpus2.txt"]
+# recorded output of toOpTree for every equation & flag combination
+GOLDEN_FILE = os.path.join(HERE, "optree_regression.json")
+# every combination of (compress_subscripts, compress_superscripts, fix_derivatives)
+FLAG_COMBOS = list(product([True, False], repeat=3))
+
+
+
+"""
+serializeOpTree:
+    Purpose:
+        convert an operator tree to nested lists so it can be compared & stored as json
+    Input:
+        node (Node) - root of operator tree
+    Output:
+        [value, [children...]] for every node in the tree, None if the tree is None
+"""
+def serializeOpTree(node):
+    if node == None:
+        return None
+    return [node.value, [serializeOpTree(child) for child in node.children]]
+
+
+
+"""
+collectOpTrees:
+    Purpose:
+        run toOpTree on every block equation of the given files with every flag combination
+    Input:
+        files (list[str]) - html files, relative to this script's folder
+    Output:
+        dict - Key: "file:equation index:flags", Value: serialized tree or the name of the raised exception
+"""
+def collectOpTrees(files):
+    results = {}
+    for filename in files:
+        mathml_strings = toMathMLStrings(os.path.join(HERE, filename))
+        for idx, (mathml_string, latex_string) in enumerate(mathml_strings):
+            for flags in FLAG_COMBOS:
+                key = filename + ":" + str(idx) + ":" + ",".join(str(flag) for flag in flags)
+                try:
+                    results[key] = serializeOpTree(toOpTree(mathml_string, *flags))
+                except Exception as e:
+                    results[key] = type(e).__name__
+    return results
+
+
+
+"""
+Usage:
+    python optree_regression.py --record [files...]   record toOpTree output as the golden file
+    python optree_regression.py [files...]            check toOpTree output against the golden file
+"""
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    record = "--record" in args
+    files = [arg for arg in args if arg != "--record"] or DEFAULT_FILES
+    results = collectOpTrees(files)
+
+    if record:
+        with open(GOLDEN_FILE, "w") as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
+        print("recorded", len(results), "trees")
+        sys.exit(0)
+
+    with open(GOLDEN_FILE, "r") as f:
+        golden = json.load(f)
+    mismatches = [key for key in results if key not in golden or golden[key] != results[key]]
+    for key in mismatches:
+        print("MISMATCH", key)
+    print(len(results) - len(mismatches), "/", len(results), "trees unchanged")
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,151 @@
+from OfflineSearchEngine import *
+from optree_regression import HERE, DEFAULT_FILES
+import tempfile
+import shutil
+import sys
+import os
+
+# page size used to walk every page of a ranking
+PAGE_SIZE = 5
+# max number of features of an equation used as a query
+MAX_QUERY_FEATURES = 6
+# scores closer than this are equal, the backends sum the same parts in different orders
+TOLERANCE = 1e-9
+# query whose features share the operator set {plus, times}
+SHARED_OPERATOR_SET_QUERY = [("times", "plus", "times"), ("plus", "times"), ("times",)]
+
+
+
+"""
+collectQueries:
+    Purpose:
+        query feature lists made from the features of the corpus equations, each query is also checked with
+        features added that repeat the operator set of one of its features in another order
+    Input:
+        equations (list) - (equation key, features) of every distinct equation
+    Output:
+        list[list[tuple[str]]] - feature lists
+"""
+def collectQueries(equations):
+    queries = [SHARED_OPERATOR_SET_QUERY]
+    for eq_key, features in equations:
+        query = sorted(features)[:MAX_QUERY_FEATURES]
+        if query == []:
+            continue
+        queries.append(query)
+        queries.append(query + [tuple(reversed(f)) + f[:1] for f in query if len(f) > 0])
+    return queries
+
+
+
+"""
+referenceScores:
+    Purpose:
+        ranked_results score of every equation computed by brute force, as score_matches scores the baseline
+        match_some_ftrs & match_some_subfeats_ordered results: exact matches over max(matched, query features),
+        plus distinct features containing every operator of some query feature over max(equation features, query features)
+    Input:
+        equations (list) - (equation, features) of every distinct equation, equation is [mathml, latex]
+        feature_list (list[tuple[str]]) - query features
+    Output:
+        dict - Key: tuple(equation), Value: score, equations scoring 0 are left out
+"""
+def referenceScores(equations, feature_list):
+    n = len(feature_list)
+    query = set(feature_list)
+    operator_sets = [set(f) for f in feature_list if len(f) > 0]
+    scores = {}
+    for equation, features in equations:
+        score = 0.0
+        num_matched = len(query & set(features))
+        if num_matched > 0:
+            score += 0.5 * num_matched / max(num_matched, n)
+        num_sub = sum(1 for f in set(features) if any(operators <= set(f) for operators in operator_sets))
+        if num_sub > 0:
+            score += 0.5 * num_sub / max(len(set(features)), n)
+        if score > 0:
+            scores[tuple(equation)] = score
+    return scores
+
+
+
+# every (equation, score) of a paged ranking, page_fn(k, cursor) returns (results, next_cursor)
+def allPages(page_fn):
+    scores, cursor = {}, None
+    while True:
+        results, cursor = page_fn(PAGE_SIZE, cursor)
+        for equation, score in results:
+            scores[tuple(equation)] = score
+        if cursor == None:
+            return scores
+
+# names of the equations whose scores differ between two rankings
+def compareScores(expected, actual):
+    return [equation[1] for equation in set(expected) | set(actual)
+            if abs(expected.get(equation, 0.0) - actual.get(equation, 0.0)) > TOLERANCE]
+
+
+
+"""
+Usage:
+    python ranking_regression.py [--corpus FOLDER] [--neo4j URI USER PASSWORD]
+        check OfflineIndex.ranked_results_page against the brute force ranked_results score of an index built from
+        the corpus folder (the repo's corpus files by default). with --neo4j, also check the paged Neo4j query against
+        the baseline ranked_results queries on that database, which is only read
+"""
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    neo4j = None
+    if "--neo4j" in args:
+        idx = args.index("--neo4j")
+        neo4j = args[idx + 1:idx + 4]
+        del args[idx:idx + 4]
+    work_dir = tempfile.mkdtemp()
+    if "--corpus" in args:
+        corpus_folder = args[args.index("--corpus") + 1]
+    else:
+        corpus_folder = os.path.join(work_dir, "corpus")
+        os.makedirs(corpus_folder)
+        for filename in DEFAULT_FILES:
+            shutil.copy(os.path.join(HERE, filename), corpus_folder)
+
+    try:
+        # distinct equations in index order, keeping the first occurrence of each key as build_index does
+        equations, seen = [], set()
+        for doc in os.listdir(corpus_folder):
+            for eq_key, fingerprint, mathml, latex, features, stats in extract_document(os.path.join(corpus_folder, doc))[1]:
+                if eq_key not in seen:
+                    seen.add(eq_key)
+                    equations.append(([mathml, latex], [tuple(operators) for ftr_key, operators, tf in features for _ in range(tf)]))
+        queries = collectQueries([(equation[0], features) for equation, features in equations])
+
+        build_index(corpus_folder, os.path.join(work_dir, "index"))
+        failed = False
+        with OfflineIndex(os.path.join(work_dir, "index")) as index:
+            mismatches = []
+            for qid, feature_list in enumerate(queries):
+                actual = allPages(lambda k, cursor: index.ranked_results_page(feature_list, k, cursor))
+                for latex in compareScores(referenceScores(equations, feature_list), actual):
+                    mismatches.append(str(qid) + ":" + str(latex))
+            for name in mismatches:
+                print("MISMATCH offline", name)
+            print("offline ranked_results_page:", len(queries) - len(set(name.split(":")[0] for name in mismatches)), "/", len(queries), "queries unchanged")
+            failed = mismatches != []
+
+        if neo4j != None:
+            import SearchEngine
+            with SearchEngine.GraphEngine(*neo4j):
+                mismatches = []
+                for qid, feature_list in enumerate(queries):
+                    expected = SearchEngine.score_matches(len(feature_list), SearchEngine.match_some_ftrs(feature_list),
+                                                          SearchEngine.match_some_subfeats_ordered(feature_list))
+                    actual = allPages(lambda k, cursor: SearchEngine.ranked_results_page(feature_list, k, cursor))
+                    for latex in compareScores(expected, actual):
+                        mismatches.append(str(qid) + ":" + str(latex))
+                for name in mismatches:
+                    print("MISMATCH neo4j", name)
+                print("neo4j ranked_results_page:", len(queries) - len(set(name.split(":")[0] for name in mismatches)), "/", len(queries), "queries unchanged")
+                failed = failed or mismatches != []
+    finally:
+        shutil.rmtree(work_dir)
+    sys.exit(1 if failed else 0)